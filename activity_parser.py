@@ -0,0 +1,198 @@
+import re
+import sys
+from datetime import date
+from timeit import default_timer as timer
+from typing import NamedTuple
+
+import lxml.html
+from lxml import etree
+
+from split_normalizer import SplitCells
+from text_parsers import date_str_to_date, elapsed_str_to_seconds, pace_str_to_seconds
+
+# XPaths are compiled once and evaluated against a single parsed tree
+ACTIVITY_NAME_XPATH = etree.XPath('//*[contains(@class, "activity-name")]')
+DATE_XPATH = etree.XPath('//div[@class="details-container"]//time')
+ATHLETE_XPATH = etree.XPath(
+    '//section[@id="heading"]//header//a[contains(@href,"athletes")]'
+)
+STATS_XPATH = etree.XPath(
+    '//section[@id="heading"]//div[contains(@class,"activity-stats")]//li'
+)
+SPLITS_XPATH = etree.XPath('//div[contains(@class, "mile-splits")]//table')
+SPLITS_HEADER_XPATH = etree.XPath(".//tr/th")
+SPLITS_ROWS_XPATH = etree.XPath(".//tr[td]")
+CELLS_XPATH = etree.XPath("./td")
+
+ATH_ID_RE = re.compile(r"/athletes/(\d+)")
+DIST_RE = re.compile(r"(\d+\.\d+) .{2}")
+PACE_RE = re.compile(r"(\d+:\d{2}) /(.{2})")
+
+# An activity counts for an event if its distance is within 5% of it
+VALID_DISTANCE_TOLERANCE = 0.05
+
+
+class SplitsNotRendered(Exception):
+    pass
+
+
+class ActivityPage(NamedTuple):
+    activity_id: int
+    athlete_id: int
+    athlete_name: str
+    activity_name: str
+    activity_date: date
+    distance: float
+    elapsed_str: str
+    elapsed_seconds: int
+    pace_str: str
+    pace_seconds: int
+    pace_units: str
+    split_columns: tuple
+    split_rows: list
+
+
+class ActivityResult(NamedTuple):
+    # One scraped activity as rows of the athletes, activities, splits and
+    # activity_events tables, ready for any consumer. Splits stay as scraped
+    # cells until a consumer normalizes its batch. job_ids are the crawl jobs
+    # it was scraped for
+    job_ids: tuple
+    athlete: dict
+    activity: dict
+    splits: SplitCells
+    events: list
+
+
+def static_text(_element):
+    # Collapse the text nodes of an element the way the browser renders them
+    return " ".join(" ".join(_element.itertext()).split())
+
+
+def stat_value(_li):
+    # First child holds the value, the label comes after it
+    return static_text(_li[0] if len(_li) else _li)
+
+
+def parse_activity_page(_html, _activity_id):
+    tree = lxml.html.fromstring(_html)
+
+    # The splits table is sometimes rendered client-side only
+    table = SPLITS_XPATH(tree)
+    if len(table) == 0:
+        raise SplitsNotRendered(f"No splits table for activity {_activity_id}")
+
+    split_columns = tuple(static_text(th) for th in SPLITS_HEADER_XPATH(table[0]))
+    split_rows = [
+        tuple(static_text(td) for td in CELLS_XPATH(tr))
+        for tr in SPLITS_ROWS_XPATH(table[0])
+    ]
+
+    # Date in the account language, e.g. "domingo, 29 de octubre de 2023"
+    activity_date = date_str_to_date(static_text(DATE_XPATH(tree)[0]))
+
+    athlete = ATHLETE_XPATH(tree)[0]
+    ath_id = int(ATH_ID_RE.search(athlete.get("href")).group(1))
+
+    stats = STATS_XPATH(tree)
+
+    dist_text = stat_value(stats[0])
+    distance = float(DIST_RE.match(dist_text.replace(",", ".")).group(1))
+
+    elapsed_text = stat_value(stats[1])
+
+    pace_str, pace_units = PACE_RE.match(stat_value(stats[2])).groups()
+
+    return ActivityPage(
+        activity_id=_activity_id,
+        athlete_id=ath_id,
+        athlete_name=static_text(athlete),
+        activity_name=static_text(ACTIVITY_NAME_XPATH(tree)[0]),
+        activity_date=activity_date,
+        distance=distance,
+        elapsed_str=elapsed_text,
+        elapsed_seconds=elapsed_str_to_seconds(elapsed_text),
+        pace_str=pace_str,
+        pace_seconds=pace_str_to_seconds(pace_str),
+        pace_units=pace_units,
+        split_columns=split_columns,
+        split_rows=split_rows,
+    )
+
+
+def activity_details(_page):
+    return {
+        "athlete_id": _page.athlete_id,
+        "athlete_name": _page.athlete_name,
+        "activity_id": _page.activity_id,
+        "activity_name": _page.activity_name,
+        "activity_date": _page.activity_date,
+        "activity_distance": _page.distance,
+        "elapsed_seconds": _page.elapsed_seconds,
+        "elapsed_time": _page.elapsed_str,
+        "pace_str": _page.pace_str,
+        "pace_seconds": _page.pace_seconds,
+        "pace_units": _page.pace_units,
+    }
+
+
+def split_cells(_page):
+    return SplitCells(int(_page.activity_id), _page.split_columns, _page.split_rows)
+
+
+def is_valid_distance(_distance, _event_distance):
+    return abs(_distance - _event_distance) / _event_distance < VALID_DISTANCE_TOLERANCE
+
+
+def activity_result(_activity_details, _split_cells, _events, job_ids=()):
+    # _events holds (event_distance, event_name) of every event the activity
+    # was found for, the first one is also stored on the activity itself
+    event_distance, event_name = _events[0]
+    distance = _activity_details["activity_distance"]
+
+    athlete = {
+        "id": _activity_details["athlete_id"],
+        "name": _activity_details["athlete_name"],
+    }
+
+    activity = {
+        "id": _activity_details["activity_id"],
+        "athlete_id": _activity_details["athlete_id"],
+        "name": _activity_details["activity_name"],
+        "search_for": event_name,
+        "valid": is_valid_distance(distance, event_distance),
+        "date": _activity_details["activity_date"],
+        "distance": _activity_details["activity_distance"],
+        "elapsed_seconds": _activity_details["elapsed_seconds"],
+        "pace_seconds": _activity_details["pace_seconds"],
+        "pace_units": _activity_details["pace_units"],
+    }
+
+    # An event found on several of its segments is tagged once
+    events = {}
+    for event_distance, name in _events:
+        events.setdefault(
+            name,
+            {
+                "activity_id": _activity_details["activity_id"],
+                "search_for": name,
+                "valid": is_valid_distance(distance, event_distance),
+            },
+        )
+
+    return ActivityResult(
+        tuple(job_ids), athlete, activity, _split_cells, list(events.values())
+    )
+
+
+if __name__ == "__main__":
+    # Benchmark: python activity_parser.py PAGE.html [ITERATIONS]
+    html = open(sys.argv[1], encoding="utf-8").read()
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    t1 = timer()
+    for _ in range(iterations):
+        parse_activity_page(html, "0")
+    t2 = timer()
+
+    print(f"parse_activity_page() {(t2-t1) / iterations * 1000:.3f}ms per page")
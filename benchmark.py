@@ -0,0 +1,337 @@
+import argparse
+import os
+import re
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer as timer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from data_model import Base
+from metrics import METRICS
+from request_scheduler import SCHEDULER
+from storage import set_engine
+
+# Offline benchmark of the whole crawl: a local server answers with synthetic
+# leaderboard and activity pages shaped like Strava's, and the HTTP pipeline
+# ingests them into a scratch database
+BENCHMARK_SIZES = [100, 1000, 10000]
+BENCHMARK_DB_URL = "sqlite:///benchmark.sqlite"
+BENCHMARK_OUTPUT_DIR = "benchmark_results"
+BENCHMARK_DISTANCE = 42.2
+# Requests per second the scheduler starts and stays at, well above what the
+# mock server serves, so the pipeline itself is measured
+BENCHMARK_RATE = 1000.0
+
+# Synthetic IDs are in the range of real ones, beyond 32 bits
+ATHLETE_ID_BASE = 1_000_000
+ACTIVITY_ID_BASE = 10_000_000_000
+SEGMENT_EFFORT_ID_BASE = 30_000_000_000
+
+LEADERBOARD_PATH_RE = re.compile(r"^/segments/(\d+)/leaderboard$")
+SEGMENT_PATH_RE = re.compile(r"^/segments/(\d+)$")
+ACTIVITY_PATH_RE = re.compile(r"^/activities/(\d+)/overview$")
+
+LEADERBOARD_HEADER = ["Rank", "Name", "Date", "Pace", "Time"]
+SEGMENT_PAGE_SIZE = 25
+
+
+def clock_str(_seconds):
+    hours, rest = divmod(int(_seconds), 3600)
+    if hours:
+        return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+    return f"{rest // 60}:{rest % 60:02d}"
+
+
+def effort_seconds(_rank):
+    # Finish times grow with rank like a big city marathon field
+    return 7500 + int(_rank * 12000 / (_rank + 2000))
+
+
+def leaderboard_rows_html(_first_rank, _last_rank):
+    rows = []
+    for rank in range(_first_rank, _last_rank + 1):
+        athlete_id = ATHLETE_ID_BASE + rank
+        activity_id = ACTIVITY_ID_BASE + rank
+        segment_effort_id = SEGMENT_EFFORT_ID_BASE + rank
+        seconds = effort_seconds(rank)
+        props = (
+            f'{{"athlete_id": {athlete_id}, "activity_id": {activity_id}, '
+            f'"segment_effort_id": {segment_effort_id}, "rank": {rank}}}'
+        )
+        rows.append(
+            f"<tr><td>{rank}</td>"
+            f"<td data-tracking-element='leaderboard_athlete' "
+            f"data-tracking-properties='{props}'>"
+            f"<a href='/athletes/{athlete_id}'>Runner {rank}</a></td>"
+            f"<td>Oct 29, 2023</td>"
+            f"<td>{clock_str(seconds / BENCHMARK_DISTANCE)} /km</td>"
+            f"<td data-tracking-element='leaderboard_effort'>"
+            f"<a href='/segment_efforts/{segment_effort_id}'>{clock_str(seconds)}</a>"
+            f"</td></tr>"
+        )
+
+    header = "".join(f"<th>{column}</th>" for column in LEADERBOARD_HEADER)
+    return (
+        f"<table class='table table-striped table-leaderboard'><thead><tr>{header}"
+        f"</tr></thead><tbody>{''.join(rows)}</tbody></table>"
+    )
+
+
+def leaderboard_fragment(_num_results, _page, _per_page):
+    # Partial results page, as fetched directly
+    first_rank = (_page - 1) * _per_page + 1
+    last_rank = min(_page * _per_page, _num_results)
+
+    return leaderboard_rows_html(first_rank, last_rank)
+
+
+def segment_page(_segment_id, _num_results, _page):
+    # Full segment page as the browser loads it, results and pagination
+    results = leaderboard_fragment(_num_results, _page, SEGMENT_PAGE_SIZE)
+    next_page = ""
+    if _page * SEGMENT_PAGE_SIZE < _num_results:
+        next_page = (
+            f"<ul class='pagination'><li class='next_page'>"
+            f"<a href='/segments/{_segment_id}?page={_page + 1}'>Next</a></li></ul>"
+        )
+
+    return (
+        f"<html><body><div id='results'>{results}{next_page}</div>"
+        f"<div class='loading-panel' style='display: none;'></div></body></html>"
+    )
+
+
+def activity_page(_activity_id):
+    # Deterministic per activity: about 1 in 20 is too short for the event
+    rng = np.random.default_rng(_activity_id)
+    rank = _activity_id - ACTIVITY_ID_BASE
+
+    distance = round(BENCHMARK_DISTANCE + abs(rng.normal(0.2, 0.15)), 2)
+    if rng.random() < 0.05:
+        distance = round(rng.uniform(10, 35), 2)
+
+    seconds = effort_seconds(max(rank, 1)) * distance / BENCHMARK_DISTANCE
+    pace = seconds / distance
+
+    full_km = int(distance)
+    paces = np.clip(rng.normal(pace, 12, full_km + 1), 150, 900).astype(int)
+    elevations = rng.integers(-8, 9, full_km + 1)
+
+    rows = [
+        f"<tr><td>{km}</td><td>{clock_str(paces[km - 1])} /km</td>"
+        f"<td>{elevations[km - 1]} m</td></tr>"
+        for km in range(1, full_km + 1)
+    ]
+    remainder = round(distance - full_km, 2)
+    if remainder > 0:
+        rows.append(
+            f"<tr><td>{remainder:.2f}</td><td>{clock_str(paces[-1])} /km</td>"
+            f"<td>{elevations[-1]} m</td></tr>"
+        )
+
+    athlete_id = ATHLETE_ID_BASE + rank
+    return (
+        f"<html><body><section id='heading'><header><h2><span class='title'>"
+        f"<a href='/athletes/{athlete_id}'>Runner {rank}</a> – Run</span></h2>"
+        f"</header><div class='details-container'>"
+        f"<time>Sunday, October 29, 2023</time>"
+        f"<h1 class='activity-name'>Benchmark Marathon</h1></div>"
+        f"<div class='activity-stats'><ul class='inline-stats'>"
+        f"<li><strong>{distance:.2f}<abbr class='unit'> km</abbr></strong>"
+        f"<div class='label'>Distance</div></li>"
+        f"<li><strong>{clock_str(seconds)}</strong>"
+        f"<div class='label'>Moving Time</div></li>"
+        f"<li><strong>{clock_str(pace)}<abbr class='unit'> /km</abbr></strong>"
+        f"<div class='label'>Pace</div></li>"
+        f"</ul></div></section>"
+        f"<div class='mile-splits'><table><thead><tr><th>KM</th><th>Pace</th>"
+        f"<th>Elev</th></tr></thead><tbody>{''.join(rows)}</tbody></table></div>"
+        f"</body></html>"
+    )
+
+
+class MockStravaHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like strava.com, so connection reuse is measured too
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page = int(query.get("page", ["1"])[0])
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        z = LEADERBOARD_PATH_RE.match(url.path)
+        if z is not None and z.group(1) in self.server.segments:
+            per_page = int(query.get("per_page", ["100"])[0])
+            html = leaderboard_fragment(
+                self.server.segments[z.group(1)], page, per_page
+            )
+            return self.respond(200, html)
+
+        z = SEGMENT_PATH_RE.match(url.path)
+        if z is not None and z.group(1) in self.server.segments:
+            html = segment_page(z.group(1), self.server.segments[z.group(1)], page)
+            return self.respond(200, html)
+
+        z = ACTIVITY_PATH_RE.match(url.path)
+        if z is not None:
+            return self.respond(200, activity_page(int(z.group(1))))
+
+        self.respond(404, "Not found")
+
+    def respond(self, _status, _html):
+        body = _html.encode("utf-8")
+        self.send_response(_status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock_server(latency=0.0, port=0):
+    # Serves every segment in server.segments (id -> number of efforts)
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockStravaHandler)
+    server.daemon_threads = True
+    server.segments = {}
+    server.latency = latency
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def peak_rss_mb():
+    # Linux reports ru_maxrss in KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def stage(_results, _size, _name, _items):
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    start = timer()
+    yield
+    seconds = timer() - start
+
+    peak_mb = np.nan
+    if tracemalloc.is_tracing():
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+
+    _results.append(
+        {
+            "size": _size,
+            "stage": _name,
+            "items": _items,
+            "seconds": seconds,
+            "items_per_second": _items / seconds if seconds else np.nan,
+            "peak_alloc_mb": peak_mb,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    )
+
+
+def run_benchmark(
+    _server,
+    sizes=BENCHMARK_SIZES,
+    db_url=BENCHMARK_DB_URL,
+    workers=4,
+    per_page=100,
+):
+    # Imported once the mock server is up, the fetchers read STRAVA_URL
+    import strava_scrape
+    from strava_http import http_session
+
+    stages = []
+    latencies = []
+
+    for size in sizes:
+        # Scratch database, recreated for every size
+        engine = set_engine(db_url)
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+
+        segment_id = str(size)
+        _server.segments[segment_id] = size
+        METRICS.reset()
+
+        with stage(stages, size, "leaderboard", size):
+            with http_session([]) as session:
+                strava_scrape.get_segment_leaderboard_http(
+                    session, segment_id, size, per_page
+                )
+
+        with stage(stages, size, "crawl", size):
+            ingested = strava_scrape.get_event_performances(
+                segment_id,
+                BENCHMARK_DISTANCE,
+                f"Benchmark {size}",
+                fetch_mode="http",
+                num_workers=workers,
+                rate_limit=None,
+                archive=None,
+                num_results=size,
+                leaderboard_per_page=per_page,
+                resume=False,
+                cookies=[],
+            )
+        if ingested != size:
+            print(f"Only {ingested} of {size} activities ingested")
+
+        summary = METRICS.summary()
+        summary.insert(0, "size", size)
+        latencies.append(summary)
+
+        engine.dispose()
+
+    return pd.DataFrame(stages), pd.concat(latencies, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCHMARK_SIZES)
+    parser.add_argument("--db-url", default=BENCHMARK_DB_URL)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--per-page", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate", type=float, default=BENCHMARK_RATE)
+    parser.add_argument("--output-dir", default=BENCHMARK_OUTPUT_DIR)
+    parser.add_argument("--no-trace-memory", action="store_true")
+    args = parser.parse_args()
+
+    mock_server = start_mock_server(args.latency)
+    SCHEDULER.configure(rate=args.rate, max_rate=args.rate)
+    os.environ["STRAVA_URL"] = f"http://127.0.0.1:{mock_server.server_port}/"
+
+    # Python allocations per stage, at some cost in throughput
+    if not args.no_trace_memory:
+        tracemalloc.start()
+
+    stages_df, latency_df = run_benchmark(
+        mock_server,
+        sizes=args.sizes,
+        db_url=args.db_url,
+        workers=args.workers,
+        per_page=args.per_page,
+    )
+    mock_server.shutdown()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    stages_df.to_csv(os.path.join(args.output_dir, "stages.csv"), index=False)
+    latency_df.to_csv(os.path.join(args.output_dir, "latency.csv"), index=False)
+
+    print(stages_df.to_string(index=False))
+    print(latency_df.to_string(index=False))
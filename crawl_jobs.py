@@ -0,0 +1,149 @@
+import datetime
+
+import pandas as pd
+from sqlalchemy import func, insert, select, update
+
+from data_model import CrawlJob, CrawlItem
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+RUNNING = "running"
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF = 30
+
+
+def open_job(_engine, _segment_id, _event_name):
+    # Latest unfinished job for this segment and event, if any
+    with _engine.connect() as conn:
+        return conn.execute(
+            select(CrawlJob.id)
+            .where(
+                CrawlJob.segment_id == _segment_id,
+                CrawlJob.search_for == _event_name,
+                CrawlJob.status == RUNNING,
+            )
+            .order_by(CrawlJob.created_at.desc())
+            .limit(1)
+        ).scalar()
+
+
+def create_job(_engine, _segment_id, _event_name, _event_distance, _leaderboard, _new):
+    # The leaderboard snapshot is stored with the job, so a restart never
+    # has to scrape it again. Activities already in the DB start as done
+    items = (
+        _leaderboard[["activity_id", "athlete_id", "segment_effort_id", "rank"]]
+        .drop_duplicates(subset="activity_id")
+        .to_dict("records")
+    )
+
+    with _engine.begin() as conn:
+        job_id = conn.execute(
+            insert(CrawlJob).returning(CrawlJob.id),
+            {
+                "segment_id": _segment_id,
+                "search_for": _event_name,
+                "event_distance": _event_distance,
+                "status": RUNNING,
+                "created_at": datetime.datetime.now(),
+            },
+        ).scalar()
+
+        for item in items:
+            item["job_id"] = job_id
+            item["rank"] = int(item["rank"])
+            item["status"] = PENDING if item["activity_id"] in _new else DONE
+            item["attempts"] = 0
+            item["error"] = None
+
+        if len(items) > 0:
+            conn.execute(insert(CrawlItem), items)
+
+    return job_id
+
+
+def job_leaderboard(_engine, _job_id):
+    with _engine.connect() as conn:
+        rows = conn.execute(
+            select(
+                CrawlItem.rank,
+                CrawlItem.athlete_id,
+                CrawlItem.activity_id,
+                CrawlItem.segment_effort_id,
+            )
+            .where(CrawlItem.job_id == _job_id)
+            .order_by(CrawlItem.rank)
+        ).all()
+
+    return pd.DataFrame(
+        rows, columns=["rank", "athlete_id", "activity_id", "segment_effort_id"]
+    )
+
+
+def pending_items(_engine, _job_id, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    with _engine.connect() as conn:
+        return list(
+            conn.execute(
+                select(CrawlItem.activity_id)
+                .where(
+                    CrawlItem.job_id == _job_id,
+                    (CrawlItem.status == PENDING)
+                    | (
+                        (CrawlItem.status == FAILED)
+                        & (CrawlItem.attempts < max_attempts)
+                    ),
+                )
+                .order_by(CrawlItem.rank)
+            ).scalars()
+        )
+
+
+def mark_done(_conn, _job_id, _activity_ids):
+    if len(_activity_ids) == 0:
+        return
+
+    _conn.execute(
+        update(CrawlItem)
+        .where(CrawlItem.job_id == _job_id, CrawlItem.activity_id.in_(_activity_ids))
+        .values(status=DONE, error=None)
+    )
+
+
+def mark_failed(_engine, _job_id, _activity_id, _error):
+    with _engine.begin() as conn:
+        return conn.execute(
+            update(CrawlItem)
+            .where(CrawlItem.job_id == _job_id, CrawlItem.activity_id == _activity_id)
+            .values(
+                status=FAILED,
+                attempts=CrawlItem.attempts + 1,
+                error=repr(_error),
+            )
+            .returning(CrawlItem.attempts)
+        ).scalar()
+
+
+def retry_delay(_attempts, backoff=DEFAULT_RETRY_BACKOFF):
+    return backoff * 2 ** (_attempts - 1)
+
+
+def finish_job(_engine, _job_id, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    # A job stays open while any item can still be retried
+    if len(pending_items(_engine, _job_id, max_attempts)) > 0:
+        return False
+
+    with _engine.begin() as conn:
+        conn.execute(update(CrawlJob).where(CrawlJob.id == _job_id).values(status=DONE))
+
+        failed = conn.execute(
+            select(func.count())
+            .select_from(CrawlItem)
+            .where(CrawlItem.job_id == _job_id, CrawlItem.status == FAILED)
+        ).scalar()
+
+    if failed > 0:
+        print(f"Job {_job_id} finished with {failed} failed activities")
+
+    return True
@@ -1,11 +1,15 @@
-from sqlalchemy import INTEGER, DATE, REAL, BOOLEAN, UUID
+from sqlalchemy import INTEGER, BIGINT, SMALLINT, DATE, REAL, BOOLEAN, UUID
+from sqlalchemy import DOUBLE_PRECISION
+from sqlalchemy import Enum, Index, Sequence
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import mapped_column
 
 import datetime
+import enum
 import uuid
+from typing import Optional
 
 
 class Base(DeclarativeBase):
@@ -18,38 +22,145 @@ class Base(DeclarativeBase):
     }
 
 
+class PaceUnit(enum.Enum):
+    km = "km"
+    mi = "mi"
+
+
+class ElevationUnit(enum.Enum):
+    m = "m"
+    ft = "ft"
+
+
+# Strava IDs are numeric and outgrow INTEGER
+StravaId = BIGINT
+
+PaceUnitType = Enum(PaceUnit, name="pace_units")
+ElevationUnitType = Enum(ElevationUnit, name="elevation_units")
+
+
 class Athlete(Base):
     __tablename__ = "athletes"
 
-    id: Mapped[str] = mapped_column(primary_key=True)
+    id: Mapped[int] = mapped_column(StravaId, primary_key=True, autoincrement=False)
     name: Mapped[str]
 
 
 class Activity(Base):
     __tablename__ = "activities"
+    __table_args__ = (Index("ix_activities_search_for_date", "search_for", "date"),)
 
-    id: Mapped[str] = mapped_column(primary_key=True)
-    athlete_id: Mapped[str] = mapped_column(ForeignKey("athletes.id"))
+    id: Mapped[int] = mapped_column(StravaId, primary_key=True, autoincrement=False)
+    athlete_id: Mapped[int] = mapped_column(
+        StravaId, ForeignKey("athletes.id"), index=True
+    )
     name: Mapped[str]
     search_for: Mapped[str]
     valid: Mapped[bool]
-    date: Mapped[datetime.datetime]
+    date: Mapped[datetime.date] = mapped_column(index=True)
     distance: Mapped[float]
-    elapsed_str: Mapped[str]
     elapsed_seconds: Mapped[int]
-    pace_str: Mapped[str]
     pace_seconds: Mapped[int]
-    pace_units: Mapped[str]
+    pace_units: Mapped[PaceUnit] = mapped_column(PaceUnitType)
 
 
 class Split(Base):
     __tablename__ = "splits"
 
     id: Mapped[uuid.UUID] = mapped_column(primary_key=True)
-    activity_id: Mapped[str] = mapped_column(ForeignKey("activities.id"))
+    activity_id: Mapped[int] = mapped_column(
+        StravaId, ForeignKey("activities.id"), index=True
+    )
     index: Mapped[int]
-    pace_str: Mapped[str]
-    pace_seconds: Mapped[int]
-    pace_units: Mapped[str]
-    elevation: Mapped[int]
-    elevation_units: Mapped[str]
+    pace_seconds: Mapped[int] = mapped_column(SMALLINT)
+    pace_units: Mapped[PaceUnit] = mapped_column(PaceUnitType)
+    elevation: Mapped[int] = mapped_column(SMALLINT)
+    elevation_units: Mapped[ElevationUnit] = mapped_column(ElevationUnitType)
+
+
+class ActivityEvent(Base):
+    # Every event an activity counts for, an activity on the segments of
+    # several events is scraped once and tagged to each of them
+    __tablename__ = "activity_events"
+
+    activity_id: Mapped[int] = mapped_column(
+        StravaId, ForeignKey("activities.id"), primary_key=True, autoincrement=False
+    )
+    search_for: Mapped[str] = mapped_column(primary_key=True, index=True)
+    valid: Mapped[bool]
+
+
+class EventKmHistogram(Base):
+    # Splits of an event per km and pace bin, kept up to date batch by batch
+    __tablename__ = "event_km_histograms"
+
+    search_for: Mapped[str] = mapped_column(primary_key=True)
+    valid: Mapped[bool] = mapped_column(primary_key=True)
+    km: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    pace_bin: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    num_splits: Mapped[int] = mapped_column(BIGINT)
+
+
+class EventKmSummary(Base):
+    # Aggregates of an event per km. Sums are added to batch by batch, the
+    # derived columns are recomputed from them and the histogram
+    __tablename__ = "event_km_summaries"
+
+    search_for: Mapped[str] = mapped_column(primary_key=True)
+    valid: Mapped[bool] = mapped_column(primary_key=True)
+    km: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    num_splits: Mapped[int] = mapped_column(BIGINT)
+    pace_sum: Mapped[int] = mapped_column(BIGINT)
+    pace_sq_sum: Mapped[int] = mapped_column(BIGINT)
+    elevation_sum: Mapped[float] = mapped_column(DOUBLE_PRECISION)
+    pace_mean: Mapped[Optional[float]]
+    pace_std: Mapped[Optional[float]]
+    elevation_mean: Mapped[Optional[float]]
+    pace_p10: Mapped[Optional[float]]
+    pace_p25: Mapped[Optional[float]]
+    pace_p50: Mapped[Optional[float]]
+    pace_p75: Mapped[Optional[float]]
+    pace_p90: Mapped[Optional[float]]
+
+
+class LeaderboardEntry(Base):
+    # Last seen leaderboard of every crawled segment
+    __tablename__ = "leaderboard_entries"
+
+    segment_id: Mapped[str] = mapped_column(primary_key=True)
+    segment_effort_id: Mapped[int] = mapped_column(
+        StravaId, primary_key=True, autoincrement=False
+    )
+    activity_id: Mapped[int] = mapped_column(StravaId)
+    athlete_id: Mapped[int] = mapped_column(StravaId)
+    rank: Mapped[int]
+    seen_at: Mapped[datetime.datetime]
+
+
+class CrawlJob(Base):
+    __tablename__ = "crawl_jobs"
+
+    # Explicit sequence, DuckDB has no SERIAL. PostgreSQL's is named the same
+    id: Mapped[int] = mapped_column(
+        Sequence("crawl_jobs_id_seq"), primary_key=True, autoincrement=True
+    )
+    segment_id: Mapped[str]
+    search_for: Mapped[str]
+    event_distance: Mapped[float]
+    status: Mapped[str]
+    created_at: Mapped[datetime.datetime]
+
+
+class CrawlItem(Base):
+    __tablename__ = "crawl_items"
+
+    job_id: Mapped[int] = mapped_column(ForeignKey("crawl_jobs.id"), primary_key=True)
+    activity_id: Mapped[int] = mapped_column(
+        StravaId, primary_key=True, autoincrement=False
+    )
+    athlete_id: Mapped[int] = mapped_column(StravaId)
+    segment_effort_id: Mapped[int] = mapped_column(StravaId)
+    rank: Mapped[int]
+    status: Mapped[str]
+    attempts: Mapped[int]
+    error: Mapped[Optional[str]]
@@ -0,0 +1,220 @@
+import csv
+import io
+
+import pandas as pd
+from sqlalchemy import func, literal, select
+
+from activity_parser import VALID_DISTANCE_TOLERANCE
+from data_model import Athlete, Activity, ActivityEvent, Split
+from event_summaries import add_stored
+from metrics import METRICS
+from split_normalizer import normalize_splits, split_id_strings, split_rows
+from storage import dialect_insert
+
+DEFAULT_BATCH_SIZE = 100
+
+SPLIT_COLUMNS = [column.name for column in Split.__table__.columns]
+
+
+def insert_ignore(_engine, _model):
+    return dialect_insert(_engine, _model).on_conflict_do_nothing()
+
+
+def untagged(_conn, _activity_ids, _event_name):
+    # Activities not tagged to the event yet
+    tagged = _conn.execute(
+        select(ActivityEvent.activity_id)
+        .where(ActivityEvent.search_for == _event_name)
+        .where(ActivityEvent.activity_id.in_(list(_activity_ids)))
+    ).scalars()
+
+    return set(_activity_ids) - set(tagged)
+
+
+def tag_events(_engine, _activity_ids, _event_distance, _event_name):
+    # Tags activities already in the DB to one more event, straight from
+    # their stored distance, so they are never scraped again for it. Their
+    # stored splits are added to the event summaries
+    if len(_activity_ids) == 0:
+        return
+
+    valid = (
+        func.abs(Activity.distance - _event_distance) / _event_distance
+        < VALID_DISTANCE_TOLERANCE
+    )
+    rows = select(Activity.id, literal(_event_name), valid).where(
+        Activity.id.in_(list(_activity_ids))
+    )
+
+    with _engine.begin() as conn:
+        new_ids = untagged(conn, _activity_ids, _event_name)
+        conn.execute(
+            insert_ignore(_engine, ActivityEvent).from_select(
+                ["activity_id", "search_for", "valid"], rows
+            )
+        )
+        if new_ids:
+            add_stored(conn, _event_name, activity_ids=new_ids)
+
+
+class BatchWriter:
+    # Buffers athletes, activities and splits and writes them in one
+    # transaction per batch, so a crash loses at most the current batch.
+    # Splits are buffered as scraped cells and normalized once per batch
+    def __init__(
+        self,
+        _engine,
+        batch_size=DEFAULT_BATCH_SIZE,
+        on_flush=None,
+        known_athletes=None,
+    ):
+        self.engine = _engine
+        self.batch_size = batch_size
+        # KnownIds of the athletes table, looked up once per batch so
+        # athletes already stored are not sent again
+        self.known_athletes = known_athletes
+
+        # Callbacks run inside the batch transaction as
+        # callback(conn, activity_rows, split_columns, event_rows),
+        # split_columns being the normalized batch as NumPy arrays and
+        # event_rows only the activity_events rows not stored before
+        self.on_flush = on_flush or []
+        self.athletes = []
+        self.activities = []
+        self.splits = []
+        self.events = []
+
+    def add(self, _athlete_row, _activity_row, _split_cells, event_rows=()):
+        if _athlete_row is not None:
+            self.athletes.append(_athlete_row)
+
+        self.activities.append(_activity_row)
+        self.splits.append(_split_cells)
+        self.events.extend(event_rows)
+
+        if len(self.activities) >= self.batch_size:
+            self.flush()
+
+    def insert_ignore(self, _conn, _model, _rows):
+        if len(_rows) == 0:
+            return
+
+        _conn.execute(insert_ignore(self.engine, _model), _rows)
+
+    def copy_splits(self, _conn, _columns):
+        # COPY is much cheaper than INSERT for the many small split rows. It
+        # goes through a temporary table, so splits already stored (same
+        # deterministic IDs) are skipped instead of failing the batch
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            zip(
+                *[
+                    (
+                        split_id_strings(_columns[column])
+                        if column == "id"
+                        else _columns[column].tolist()
+                    )
+                    for column in SPLIT_COLUMNS
+                ]
+            )
+        )
+        buffer.seek(0)
+
+        columns = ", ".join(f'"{column}"' for column in SPLIT_COLUMNS)
+        cursor = _conn.connection.driver_connection.cursor()
+        cursor.execute(
+            f"CREATE TEMP TABLE split_rows (LIKE {Split.__tablename__}) ON COMMIT DROP"
+        )
+        cursor.copy_expert(
+            f"COPY split_rows ({columns}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        cursor.execute(
+            f"INSERT INTO {Split.__tablename__} ({columns}) "
+            f"SELECT {columns} FROM split_rows ON CONFLICT DO NOTHING"
+        )
+        cursor.close()
+
+    def append_splits(self, _conn, _columns):
+        # DuckDB inserts row by row from executemany, a registered DataFrame
+        # is scanned in one statement
+        frame = pd.DataFrame(
+            {column: _columns[column] for column in SPLIT_COLUMNS if column != "id"}
+        )
+        frame.insert(0, "id", split_id_strings(_columns["id"]))
+
+        columns = ", ".join(f'"{column}"' for column in SPLIT_COLUMNS)
+        duckdb_conn = _conn.connection.driver_connection
+        duckdb_conn.register("split_rows", frame)
+        try:
+            duckdb_conn.execute(
+                f"INSERT INTO {Split.__tablename__} ({columns}) "
+                f"SELECT {columns} FROM split_rows ON CONFLICT DO NOTHING"
+            )
+        finally:
+            duckdb_conn.unregister("split_rows")
+
+    def new_athletes(self):
+        # One row per athlete, without those already stored
+        athletes = {int(row["id"]): row for row in self.athletes}
+        if self.known_athletes is None:
+            return list(athletes.values())
+
+        return [athletes[_id] for _id in self.known_athletes.filter_new(athletes)]
+
+    def new_events(self, _conn):
+        # A re-scraped activity keeps its tags, and is not counted twice
+        new_events = []
+        by_event = {}
+        for row in self.events:
+            by_event.setdefault(row["search_for"], []).append(row)
+
+        for event_name, rows in by_event.items():
+            new_ids = untagged(_conn, [row["activity_id"] for row in rows], event_name)
+            new_events.extend(row for row in rows if row["activity_id"] in new_ids)
+
+        return new_events
+
+    def flush(self):
+        if len(self.activities) == 0:
+            return
+
+        with METRICS.timed("split_normalize_seconds"):
+            splits = normalize_splits(self.splits)
+        num_splits = len(splits["id"])
+
+        athletes = self.new_athletes()
+
+        with METRICS.timed("db_flush_seconds"), self.engine.begin() as conn:
+            self.insert_ignore(conn, Athlete, athletes)
+            self.insert_ignore(conn, Activity, self.activities)
+
+            if num_splits == 0:
+                pass
+            elif self.engine.dialect.name == "postgresql":
+                self.copy_splits(conn, splits)
+            elif self.engine.dialect.name == "duckdb":
+                self.append_splits(conn, splits)
+            else:
+                self.insert_ignore(conn, Split, split_rows(splits))
+
+            events = self.new_events(conn)
+            self.insert_ignore(conn, ActivityEvent, events)
+
+            for callback in self.on_flush:
+                callback(conn, self.activities, splits, events)
+
+        if self.known_athletes is not None:
+            for athlete in athletes:
+                self.known_athletes.add(int(athlete["id"]))
+
+        METRICS.increment("db_flushed_activities_total", len(self.activities))
+        METRICS.increment("db_flushed_splits_total", num_splits)
+        print(f"Flushed {len(self.activities)} activities, {num_splits} splits")
+
+        self.athletes = []
+        self.activities = []
+        self.splits = []
+        self.events = []
+
+    def close(self):
+        self.flush()
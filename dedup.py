@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+from sqlalchemy import any_, literal, select
+from sqlalchemy.dialects import postgresql
+
+DEDUP_CHUNK_SIZE = 500
+DEFAULT_CACHE_SIZE = 100_000
+
+
+class KnownIds:
+    # IDs known to exist in a table. Only the IDs being looked at are ever
+    # queried, and the bounded LRU cache keeps memory flat however large the
+    # table grows
+    def __init__(self, _engine, _model, cache_size=DEFAULT_CACHE_SIZE):
+        self.engine = _engine
+        self.model = _model
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __contains__(self, _id):
+        if _id in self.cache:
+            self.cache.move_to_end(_id)
+            return True
+
+        return False
+
+    def add(self, _id):
+        self.cache[_id] = None
+        self.cache.move_to_end(_id)
+
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def query_existing(self, _ids):
+        id_column = self.model.id
+
+        if self.engine.dialect.name == "postgresql":
+            # One array parameter, whatever the number of IDs
+            condition = id_column == any_(
+                literal(_ids, type_=postgresql.ARRAY(id_column.type))
+            )
+        else:
+            condition = id_column.in_(_ids)
+
+        with self.engine.connect() as conn:
+            return {row[0] for row in conn.execute(select(id_column).where(condition))}
+
+    def filter_new(self, _ids):
+        # Strava IDs, as plain ints the DB driver can bind
+        ids = list(dict.fromkeys(int(_id) for _id in _ids))
+        unknown = [_id for _id in ids if _id not in self]
+
+        existing = set()
+        if len(unknown) > 0:
+            existing = self.query_existing(unknown)
+            for _id in existing:
+                self.add(_id)
+
+        return [_id for _id in unknown if _id not in existing]
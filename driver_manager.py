@@ -0,0 +1,439 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import deque
+from timeit import default_timer as timer
+
+import numpy as np
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.wait import WebDriverWait
+from webdriver_manager.chrome import ChromeDriverManager
+
+from metrics import METRICS
+from strava_http import SessionExpired, http_session, resolve_url
+
+LOGIN_URL = "https://www.strava.com/login"
+DASHBOARD_URL = "https://www.strava.com/dashboard"
+SESSION_COOKIE = "_strava4_session"
+
+# Driver path, cookies and browser profiles survive between runs
+BROWSER_DIR = os.getenv("STRAVA_BROWSER_DIR", "browser")
+DRIVER_PATH_FILE = os.path.join(BROWSER_DIR, "chromedriver_path")
+COOKIES_FILE = os.path.join(BROWSER_DIR, "cookies.json")
+PROFILES_DIR = os.path.join(BROWSER_DIR, "profiles")
+
+DEFAULT_MAX_PAGES = 500
+LOGIN_TIMEOUT = 30
+
+# Lean browsers only fetch what the text of a page needs
+LEAN_BROWSER = os.getenv("STRAVA_LEAN_BROWSER", "1") != "0"
+BLOCKED_URLS = [
+    # Images, fonts and media
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.webp",
+    "*.svg",
+    "*.ico",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.mp4",
+    "*.webm",
+    "*.mp3",
+    # Maps
+    "*mapbox.com*",
+    "*maps.googleapis.com*",
+    "*heatmap-external*",
+    "*tile*.strava.com*",
+    # Analytics, ads and other third-party scripts
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*facebook.net*",
+    "*facebook.com*",
+    "*branch.io*",
+    "*sentry.io*",
+    "*segment.io*",
+    "*snowplow*",
+    "*optimizely.com*",
+    "*hotjar.com*",
+    "*onetrust.com*",
+    "*cookielaw.org*",
+]
+LEAN_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.managed_default_content_settings.media_stream": 2,
+    "profile.managed_default_content_settings.geolocation": 2,
+    "profile.managed_default_content_settings.notifications": 2,
+    "profile.managed_default_content_settings.plugins": 2,
+    "profile.managed_default_content_settings.popups": 2,
+}
+LEAN_ARGUMENTS = [
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--mute-audio",
+    "--no-first-run",
+    "--blink-settings=imagesEnabled=false",
+    "--disk-cache-size=104857600",
+    "--media-cache-size=1",
+]
+
+# Waits poll often and give up after a few times what recent waits took
+WAIT_POLL_INTERVAL = 0.05
+MIN_WAIT_TIMEOUT = 5
+MAX_WAIT_TIMEOUT = 60
+WAIT_HISTORY = 200
+WAIT_WARMUP = 20
+WAIT_TIMEOUT_FACTOR = 4
+
+driver_path_lock = threading.Lock()
+cookies_lock = threading.Lock()
+profiles_lock = threading.Lock()
+profiles_in_use = set()
+
+
+class LoginFailed(Exception):
+    pass
+
+
+def chromedriver_path():
+    # ChromeDriverManager resolves the binary over the network, so its answer
+    # is kept on disk until the binary it points to is gone
+    with driver_path_lock:
+        if os.path.exists(DRIVER_PATH_FILE):
+            with open(DRIVER_PATH_FILE, encoding="utf-8") as f:
+                path = f.read().strip()
+            if os.path.exists(path):
+                return path
+
+        path = ChromeDriverManager().install()
+        os.makedirs(BROWSER_DIR, exist_ok=True)
+        with open(DRIVER_PATH_FILE, "w", encoding="utf-8") as f:
+            f.write(path)
+
+        return path
+
+
+def acquire_profile():
+    # Chrome locks its profile directory, so every live driver of this
+    # process gets its own warm profile, the same ones on every run
+    with profiles_lock:
+        _idx = 0
+        while _idx in profiles_in_use:
+            _idx += 1
+        profiles_in_use.add(_idx)
+
+    return _idx, os.path.abspath(os.path.join(PROFILES_DIR, f"worker-{_idx}"))
+
+
+def release_profile(_idx):
+    with profiles_lock:
+        profiles_in_use.discard(_idx)
+
+
+def chrome_driver(_profile_dir, lean=LEAN_BROWSER):
+    webdriver_options = webdriver.ChromeOptions()
+    webdriver_options.add_argument("--headless=new")
+    webdriver_options.add_argument(f"--user-data-dir={_profile_dir}")
+    webdriver_options.page_load_strategy = "eager"
+
+    if lean:
+        for argument in LEAN_ARGUMENTS:
+            webdriver_options.add_argument(argument)
+        webdriver_options.add_experimental_option("prefs", LEAN_PREFS)
+
+    driver = webdriver.Chrome(
+        service=Service(executable_path=chromedriver_path()),
+        options=webdriver_options,
+    )
+
+    if lean:
+        # Blocked before they are requested, prefs alone still fetch some
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+
+    return driver
+
+
+class AdaptiveWait:
+    # WebDriverWait whose timeout follows the waits that succeeded lately:
+    # WAIT_TIMEOUT_FACTOR times their p95, within [min_timeout, max_timeout].
+    # A page that is not going to render fails fast instead of after 60s
+    def __init__(self, min_timeout=MIN_WAIT_TIMEOUT, max_timeout=MAX_WAIT_TIMEOUT):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=WAIT_HISTORY)
+
+    def timeout(self):
+        with self.lock:
+            if len(self.recent) < WAIT_WARMUP:
+                return self.max_timeout
+            p95 = np.quantile(self.recent, 0.95)
+
+        return min(self.max_timeout, max(self.min_timeout, WAIT_TIMEOUT_FACTOR * p95))
+
+    def until(self, _driver, _condition, ignored_exceptions=None):
+        start = timer()
+        result = WebDriverWait(
+            _driver,
+            self.timeout(),
+            poll_frequency=WAIT_POLL_INTERVAL,
+            ignored_exceptions=ignored_exceptions,
+        ).until(_condition)
+
+        with self.lock:
+            self.recent.append(timer() - start)
+
+        return result
+
+
+SPLITS_WAIT = AdaptiveWait()
+LEADERBOARD_WAIT = AdaptiveWait()
+
+
+def load_cookies():
+    # (cookies, user_agent) of the last login, None while there is no
+    # unexpired session cookie
+    with cookies_lock:
+        if not os.path.exists(COOKIES_FILE):
+            return None, None
+        with open(COOKIES_FILE, encoding="utf-8") as f:
+            saved = json.load(f)
+
+    now = time.time()
+    cookies = [c for c in saved["cookies"] if c.get("expiry", now + 1) > now]
+    if not any(c["name"] == SESSION_COOKIE for c in cookies):
+        return None, None
+
+    return cookies, saved["user_agent"]
+
+
+def save_cookies(_cookies, _user_agent):
+    with cookies_lock:
+        os.makedirs(BROWSER_DIR, exist_ok=True)
+        # Holds the live session cookie, readable by the owner only
+        fd = os.open(
+            COOKIES_FILE + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        os.chmod(COOKIES_FILE + ".tmp", 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"cookies": _cookies, "user_agent": _user_agent}, f)
+        os.replace(COOKIES_FILE + ".tmp", COOKIES_FILE)
+
+
+def login(_driver, _email, _password):
+    # The warm profile usually still holds a session, then the saved cookies
+    # are tried, the login form only comes last
+    _driver.get(url=DASHBOARD_URL)
+    if "/login" not in _driver.current_url:
+        return
+
+    cookies, _ = load_cookies()
+    if cookies is not None:
+        for cookie in cookies:
+            _driver.add_cookie(cookie)
+        _driver.get(url=DASHBOARD_URL)
+        if "/login" not in _driver.current_url:
+            return
+        _driver.get(url=LOGIN_URL)
+
+    wait = WebDriverWait(_driver, LOGIN_TIMEOUT, poll_frequency=WAIT_POLL_INTERVAL)
+    wait.until(EC.element_to_be_clickable((By.ID, "email")))
+
+    # The cookie banner, if shown at all, renders together with the form
+    for button in _driver.find_elements(
+        By.XPATH, './/button[@class="btn-deny-cookie-banner"]'
+    ):
+        button.click()
+
+    _driver.find_element(by=By.ID, value="email").send_keys(_email)
+    _driver.find_element(by=By.ID, value="password").send_keys(_password)
+    _driver.find_element(by=By.XPATH, value='.//*[@type="submit"]').submit()
+
+    try:
+        wait.until(
+            lambda d: "/login" not in d.current_url and "/session" not in d.current_url
+        )
+    except TimeoutException:
+        raise LoginFailed(f"Still on {_driver.current_url} after logging in")
+
+    METRICS.increment("browser_logins_total")
+
+
+class ManagedDriver:
+    # Stands in for a logged-in webdriver.Chrome. The browser starts on the
+    # first page load, and every page load first checks it is still alive.
+    # A dead browser, or one that served max_pages pages, is replaced by a
+    # fresh logged-in one. Everything else is passed to the live driver
+    def __init__(
+        self, _email, _password, max_pages=DEFAULT_MAX_PAGES, lean=LEAN_BROWSER
+    ):
+        self.email = _email
+        self.password = _password
+        self.max_pages = max_pages
+        self.lean = lean
+        self.driver = None
+        self.profile = None
+        self.pages = 0
+        # Set by ensure(), so the next get() does not check again
+        self.checked = False
+
+    def __getattr__(self, _name):
+        # Plain pass-through, checks and recycling only happen in get(). A
+        # recycle here would lose the page just loaded
+        if self.driver is None:
+            self.start()
+
+        return getattr(self.driver, _name)
+
+    def healthy(self):
+        try:
+            return (
+                self.driver.service.is_connectable()
+                and self.driver.execute_script("return 1") == 1
+            )
+        except WebDriverException:
+            return False
+
+    def ensure(self):
+        if self.driver is not None:
+            if self.pages >= self.max_pages:
+                METRICS.increment("browser_recycles_total", reason="max_pages")
+                self.quit()
+            elif not self.healthy():
+                METRICS.increment("browser_recycles_total", reason="unhealthy")
+                self.quit()
+
+        if self.driver is None:
+            self.start()
+
+        self.checked = True
+        return self.driver
+
+    def start(self):
+        with METRICS.timed("browser_start_seconds"):
+            self.profile, profile_dir = acquire_profile()
+            self.driver = chrome_driver(profile_dir, lean=self.lean)
+            login(self.driver, self.email, self.password)
+            save_cookies(
+                self.driver.get_cookies(),
+                self.driver.execute_script("return navigator.userAgent"),
+            )
+        self.pages = 0
+
+    def get(self, url):
+        # Callers that time or schedule the load call ensure() first, so a
+        # browser start is not counted as part of it
+        driver = self.driver if self.checked else self.ensure()
+        self.checked = False
+        self.pages += 1
+
+        return driver.get(url=url)
+
+    def quit(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except WebDriverException:
+                pass
+            self.driver = None
+        self.checked = False
+
+        if self.profile is not None:
+            release_profile(self.profile)
+            self.profile = None
+
+    def close(self):
+        self.quit()
+
+
+def session_cookies(_email, _password):
+    # Saved cookies are checked with one cheap request, a browser is only
+    # started when they are missing or expired
+    cookies, user_agent = load_cookies()
+    if cookies is not None:
+        with http_session(cookies, user_agent) as session:
+            try:
+                resolve_url(session, DASHBOARD_URL)
+                return cookies, user_agent
+            except SessionExpired:
+                pass
+
+    driver = ManagedDriver(_email, _password)
+    try:
+        driver.ensure()
+        cookies, user_agent = load_cookies()
+    finally:
+        driver.quit()
+
+    if cookies is None:
+        raise LoginFailed("Logged in without getting a session cookie")
+
+    return cookies, user_agent
+
+
+def browser_rss(_driver):
+    # Resident memory of chromedriver and every Chrome process under it
+    import psutil
+
+    process = psutil.Process(_driver.service.process.pid)
+
+    return sum(p.memory_info().rss for p in [process] + process.children(True))
+
+
+if __name__ == "__main__":
+    # Benchmark, full against lean browser, over the same activity pages:
+    # python driver_manager.py ACTIVITY_ID [ACTIVITY_ID ...] [--repeat N]
+    from dotenv import load_dotenv
+
+    from strava_http import ACT_BASE_URL
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("activities", nargs="+")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    load_dotenv()
+    splits_table = (By.XPATH, '//div[contains(@class, "mile-splits")]')
+
+    for lean in [False, True]:
+        driver = ManagedDriver(
+            os.getenv("STRAVA_LOGIN_EMAIL"),
+            os.getenv("STRAVA_LOGIN_PASSWORD"),
+            lean=lean,
+        )
+        driver.ensure()
+
+        page_seconds = []
+        peak_rss = 0
+        for _ in range(args.repeat):
+            for activity_id in args.activities:
+                start = timer()
+                driver.get(f"{ACT_BASE_URL}{activity_id}/overview")
+                WebDriverWait(
+                    driver, MAX_WAIT_TIMEOUT, poll_frequency=WAIT_POLL_INTERVAL
+                ).until(EC.presence_of_element_located(splits_table))
+                page_seconds.append(timer() - start)
+                peak_rss = max(peak_rss, browser_rss(driver.driver))
+
+        driver.quit()
+
+        print(
+            f"{'lean' if lean else 'full'}: {len(page_seconds)} pages, "
+            f"p50 {np.median(page_seconds):.3f}s, "
+            f"p95 {np.quantile(page_seconds, 0.95):.3f}s, "
+            f"peak RSS {peak_rss / 2**20:.0f} MB"
+        )
@@ -0,0 +1,246 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete, select
+
+from data_model import (
+    ActivityEvent,
+    Base,
+    EventKmHistogram,
+    EventKmSummary,
+    PaceUnit,
+    Split,
+)
+from storage import dialect_insert
+
+# Per-event, per-km aggregates of the splits, so dashboards read a few rows
+# instead of joining activities and splits. They are added to inside every
+# batch transaction, only splits paced per km count
+SUMMARY_KEYS = ["search_for", "valid", "km"]
+SUMMARY_SUMS = ["num_splits", "pace_sum", "pace_sq_sum", "elevation_sum"]
+SUMMARY_PERCENTILES = [10, 25, 50, 75, 90]
+
+# Percentiles come from the histogram, to within half a bin
+PACE_BIN_SECONDS = 5
+FEET_TO_METRES = 0.3048
+
+
+def ensure_summary_tables(_engine):
+    Base.metadata.create_all(
+        _engine, tables=[EventKmHistogram.__table__, EventKmSummary.__table__]
+    )
+
+
+def summary_frame(_splits, _events):
+    # One row per split and event of its activity. _splits are split
+    # columns with plain string units, _events activity_events rows
+    pace_units = np.asarray(_splits["pace_units"], dtype=object)
+    per_km = pace_units == "km"
+
+    elevation = np.asarray(_splits["elevation"], dtype=np.float64)
+    elevation_units = np.asarray(_splits["elevation_units"], dtype=object)
+    elevation = np.where(elevation_units == "ft", elevation * FEET_TO_METRES, elevation)
+
+    splits = pd.DataFrame(
+        {
+            "activity_id": np.asarray(_splits["activity_id"], dtype=np.int64)[per_km],
+            # A split ending at 2000m is km 2, a last partial one at 42195m km 43
+            "km": (np.asarray(_splits["index"], dtype=np.int64)[per_km] + 999) // 1000,
+            "pace_seconds": np.asarray(_splits["pace_seconds"], dtype=np.int64)[per_km],
+            "elevation": elevation[per_km],
+        }
+    )
+    events = pd.DataFrame(
+        list(_events), columns=["activity_id", "search_for", "valid"]
+    ).drop_duplicates(subset=["activity_id", "search_for"])
+    events["activity_id"] = events["activity_id"].astype(np.int64)
+
+    return splits.merge(events, on="activity_id")
+
+
+def upsert_add(_conn, _model, _rows, _keys, _columns):
+    # New keys are inserted, existing ones get the values added
+    table = _model.__table__
+    stmt = dialect_insert(_conn, _model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=_keys,
+        set_={column: table.c[column] + stmt.excluded[column] for column in _columns},
+    )
+    _conn.execute(stmt, _rows)
+
+
+def records(_frame):
+    # Plain Python values, as the DB drivers bind them
+    return [
+        {column: getattr(value, "item", lambda: value)() for column, value in row}
+        for row in (zip(_frame.columns, values) for values in _frame.itertuples(False))
+    ]
+
+
+def refresh_derived(_conn, _search_for):
+    # Means and percentiles of the touched events, from their sums and
+    # histograms: a few hundred rows per event, whatever its size
+    summaries = pd.read_sql(
+        select(EventKmSummary).where(EventKmSummary.search_for.in_(_search_for)),
+        _conn,
+    )
+    histogram = pd.read_sql(
+        select(EventKmHistogram)
+        .where(EventKmHistogram.search_for.in_(_search_for))
+        .order_by(*[EventKmHistogram.__table__.c[key] for key in SUMMARY_KEYS])
+        .order_by(EventKmHistogram.pace_bin),
+        _conn,
+    )
+    if len(summaries.index) == 0:
+        return
+
+    count = summaries["num_splits"]
+    summaries["pace_mean"] = summaries["pace_sum"] / count
+    summaries["pace_std"] = np.sqrt(
+        np.maximum(summaries["pace_sq_sum"] / count - summaries["pace_mean"] ** 2, 0)
+    )
+    summaries["elevation_mean"] = summaries["elevation_sum"] / count
+
+    # Nearest-rank percentile: the first bin whose cumulative count reaches it
+    groups = histogram.groupby(SUMMARY_KEYS, sort=False)["num_splits"]
+    cumulative = groups.cumsum()
+    total = groups.transform("sum")
+    summaries = summaries.set_index(SUMMARY_KEYS)
+    for p in SUMMARY_PERCENTILES:
+        reached = histogram[cumulative >= np.ceil(p / 100 * total)]
+        first_bin = reached.groupby(SUMMARY_KEYS, sort=False)["pace_bin"].first()
+        summaries[f"pace_p{p}"] = first_bin + PACE_BIN_SECONDS / 2
+    summaries = summaries.reset_index()
+
+    derived = ["pace_mean", "pace_std", "elevation_mean"] + [
+        f"pace_p{p}" for p in SUMMARY_PERCENTILES
+    ]
+    stmt = dialect_insert(_conn, EventKmSummary)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=SUMMARY_KEYS,
+        set_={column: stmt.excluded[column] for column in derived},
+    )
+    _conn.execute(stmt, records(summaries))
+
+
+def add_to_summaries(_conn, _frame):
+    if len(_frame.index) == 0:
+        return
+
+    frame = _frame.assign(
+        pace_bin=_frame["pace_seconds"] // PACE_BIN_SECONDS * PACE_BIN_SECONDS,
+        pace_sq=_frame["pace_seconds"] ** 2,
+    )
+
+    histogram = (
+        frame.groupby(SUMMARY_KEYS + ["pace_bin"]).size().rename("num_splits")
+    ).reset_index()
+    sums = (
+        frame.groupby(SUMMARY_KEYS)
+        .agg(
+            num_splits=("pace_seconds", "size"),
+            pace_sum=("pace_seconds", "sum"),
+            pace_sq_sum=("pace_sq", "sum"),
+            elevation_sum=("elevation", "sum"),
+        )
+        .reset_index()
+    )
+
+    upsert_add(
+        _conn,
+        EventKmHistogram,
+        records(histogram),
+        SUMMARY_KEYS + ["pace_bin"],
+        ["num_splits"],
+    )
+    upsert_add(_conn, EventKmSummary, records(sums), SUMMARY_KEYS, SUMMARY_SUMS)
+
+    refresh_derived(_conn, sorted(frame["search_for"].unique()))
+
+
+def update_summaries(_conn, _activity_rows, _split_columns, _event_rows):
+    # BatchWriter on_flush callback
+    add_to_summaries(_conn, summary_frame(_split_columns, _event_rows))
+
+
+def add_stored(_conn, _search_for, activity_ids=None):
+    # Splits already in the DB, of the given activities or the whole event
+    query = (
+        select(
+            Split.activity_id,
+            Split.index,
+            Split.pace_seconds,
+            Split.elevation,
+            Split.elevation_units,
+            ActivityEvent.search_for,
+            ActivityEvent.valid,
+        )
+        .join(ActivityEvent, ActivityEvent.activity_id == Split.activity_id)
+        .where(ActivityEvent.search_for == _search_for)
+        .where(Split.pace_units == PaceUnit.km)
+    )
+    if activity_ids is not None:
+        query = query.where(Split.activity_id.in_(list(activity_ids)))
+
+    stored = pd.read_sql(query, _conn)
+    if len(stored.index) == 0:
+        return
+
+    splits = {column: stored[column].to_numpy() for column in stored}
+    splits["pace_units"] = np.full(len(stored.index), "km", dtype=object)
+    splits["elevation_units"] = np.array(
+        [getattr(unit, "value", unit) for unit in stored["elevation_units"]],
+        dtype=object,
+    )
+    events = stored[["activity_id", "search_for", "valid"]].drop_duplicates()
+
+    add_to_summaries(
+        _conn, summary_frame(splits, events.itertuples(index=False, name=None))
+    )
+
+
+def rebuild_summaries(_engine, _search_for):
+    # From scratch, e.g. for events crawled before summaries were kept
+    with _engine.begin() as conn:
+        for model in [EventKmHistogram, EventKmSummary]:
+            conn.execute(delete(model).where(model.search_for == _search_for))
+        add_stored(conn, _search_for)
+
+
+def event_summary(_engine, _search_for, valid=True):
+    with _engine.connect() as conn:
+        return pd.read_sql(
+            select(EventKmSummary)
+            .where(EventKmSummary.search_for == _search_for)
+            .where(EventKmSummary.valid == valid)
+            .order_by(EventKmSummary.km),
+            conn,
+        )
+
+
+def event_histogram(_engine, _search_for, _km, valid=True):
+    with _engine.connect() as conn:
+        return pd.read_sql(
+            select(EventKmHistogram.pace_bin, EventKmHistogram.num_splits)
+            .where(EventKmHistogram.search_for == _search_for)
+            .where(EventKmHistogram.valid == valid)
+            .where(EventKmHistogram.km == _km)
+            .order_by(EventKmHistogram.pace_bin),
+            conn,
+        )
+
+
+if __name__ == "__main__":
+    from storage import get_engine
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["show", "rebuild"])
+    parser.add_argument("--event", default="Frankfurt Marathon")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        ensure_summary_tables(get_engine())
+        rebuild_summaries(get_engine(), args.event)
+
+    print(event_summary(get_engine(), args.event).to_string(index=False))
@@ -0,0 +1,68 @@
+import json
+from urllib.parse import urljoin
+
+import lxml.html
+import numpy as np
+import pandas as pd
+from lxml import etree
+
+from activity_parser import static_text
+
+STRAVA_URL = "https://www.strava.com/"
+
+HEADER_XPATH = etree.XPath("//table//tr/th")
+ROWS_XPATH = etree.XPath(
+    '//table//tr[td[@data-tracking-element="leaderboard_athlete"]]'
+)
+CELLS_XPATH = etree.XPath("./td")
+ATHLETE_PROPS_XPATH = etree.XPath(
+    './td[@data-tracking-element="leaderboard_athlete"]/@data-tracking-properties'
+)
+EFFORT_HREF_XPATH = etree.XPath(
+    './td[@data-tracking-element="leaderboard_effort"]//a/@href'
+)
+
+ID_COLUMNS = ["athlete_id", "activity_id", "segment_effort_id"]
+
+
+def parse_leaderboard_page(_html):
+    # Every column of a results page in one parse, as plain lists
+    tree = lxml.html.fromstring(_html)
+
+    header = [static_text(th) for th in HEADER_XPATH(tree)]
+    page = {column: [] for column in header}
+    page.update({"link": [], "athlete_id": [], "activity_id": []})
+    page.update({"segment_effort_id": [], "rank": []})
+
+    for tr in ROWS_XPATH(tree):
+        cells = CELLS_XPATH(tr)
+        for _idx, column in enumerate(header):
+            page[column].append(static_text(cells[_idx]) if _idx < len(cells) else None)
+
+        hrefs = EFFORT_HREF_XPATH(tr)
+        page["link"].append(urljoin(STRAVA_URL, hrefs[0]) if hrefs else None)
+
+        json_obj = json.loads(ATHLETE_PROPS_XPATH(tr)[0])
+        for column in ID_COLUMNS:
+            page[column].append(int(json_obj[column]))
+        page["rank"].append(int(json_obj["rank"]))
+
+    return page
+
+
+def page_len(_page):
+    return len(_page["rank"])
+
+
+def leaderboard_dataframe(_pages):
+    # Pages are only concatenated once, as lists, at the end of the crawl
+    columns = {}
+    for page in _pages:
+        for column, values in page.items():
+            columns.setdefault(column, []).extend(values)
+
+    leaderboard_df = pd.DataFrame(columns)
+    for column in ID_COLUMNS + ["rank"]:
+        leaderboard_df[column] = np.asarray(columns.get(column, []), dtype=np.int64)
+
+    return leaderboard_df
@@ -0,0 +1,56 @@
+import datetime
+
+from sqlalchemy import select
+
+from data_model import LeaderboardEntry
+from storage import dialect_insert
+
+SNAPSHOT_COLUMNS = ["segment_effort_id", "activity_id", "athlete_id", "rank"]
+
+
+def known_efforts(_engine, _segment_id):
+    with _engine.connect() as conn:
+        return set(
+            conn.execute(
+                select(LeaderboardEntry.segment_effort_id).where(
+                    LeaderboardEntry.segment_id == _segment_id
+                )
+            ).scalars()
+        )
+
+
+def save_snapshot(_engine, _segment_id, _leaderboard):
+    # Upsert, efforts already seen only get their current rank
+    rows = _leaderboard[SNAPSHOT_COLUMNS].drop_duplicates(subset="segment_effort_id")
+    rows = [
+        {column: int(value) for column, value in row.items()}
+        for row in rows.to_dict("records")
+    ]
+    if len(rows) == 0:
+        return
+
+    seen_at = datetime.datetime.now()
+    for row in rows:
+        row["segment_id"] = _segment_id
+        row["seen_at"] = seen_at
+
+    stmt = dialect_insert(_engine, LeaderboardEntry)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["segment_id", "segment_effort_id"],
+        set_={"rank": stmt.excluded.rank, "seen_at": stmt.excluded.seen_at},
+    )
+
+    with _engine.begin() as conn:
+        conn.execute(stmt, rows)
+
+
+def unseen_efforts_stop(_known_efforts):
+    # Stops a leaderboard crawl after the first page without an unseen
+    # effort. A page identical to the snapshot has none, so it also stops
+    # once the pages no longer change
+    def stop(_page):
+        return all(
+            effort_id in _known_efforts for effort_id in _page["segment_effort_id"]
+        )
+
+    return stop
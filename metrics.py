@@ -0,0 +1,214 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+import numpy as np
+import pandas as pd
+
+METRICS_PREFIX = "strava_"
+SUMMARY_QUANTILES = [0.5, 0.95, 0.99]
+
+# Phases of the activity-detail stage, in the order they run:
+#   navigation  effort redirect, driver.get / HTTP fetch / archive lookup
+#   wait        until the browser has rendered the splits table
+#   extraction  page_source round-trip and archiving
+#   parsing     parse_activity_page
+# Splits are normalized per batch, as split_normalize_seconds
+ACTIVITY_PHASES = ["navigation", "wait", "extraction", "parsing"]
+
+
+def label_key(_labels):
+    return tuple(sorted((name, str(value)) for name, value in _labels.items()))
+
+
+class Metrics:
+    # Counters and histograms of a crawl, safe to update from any worker.
+    # Histograms keep every observation, a 5000 activity run is a few 10k
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.jsonl = None
+
+    def log_to(self, _path):
+        # Every update is also appended to _path as one JSON line
+        with self.lock:
+            if self.jsonl is not None:
+                self.jsonl.close()
+            self.jsonl = open(_path, "a", encoding="utf-8") if _path else None
+
+    def log(self, _kind, _name, _value, _labels):
+        if self.jsonl is None:
+            return
+
+        record = {"ts": time.time(), "type": _kind, "name": _name, "value": _value}
+        record.update(_labels)
+        self.jsonl.write(json.dumps(record) + "\n")
+
+    def increment(self, _name, value=1, **labels):
+        key = (_name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.log("counter", _name, value, labels)
+
+    def observe(self, _name, _seconds, **labels):
+        key = (_name, label_key(labels))
+        with self.lock:
+            self.histograms.setdefault(key, []).append(_seconds)
+            self.log("histogram", _name, _seconds, labels)
+
+    @contextmanager
+    def timed(self, _name, **labels):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(_name, timer() - start, **labels)
+
+    def __call__(self, _activity_id, _phase, _seconds):
+        # Also usable as an on_phase hook
+        self.observe("activity_phase_seconds", _seconds, phase=_phase)
+
+    def summary(self):
+        with self.lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+
+        rows = []
+        for (name, labels), values in sorted(histograms.items()):
+            quantiles = np.quantile(values, SUMMARY_QUANTILES)
+            row = {
+                "metric": name,
+                "labels": ",".join(f"{k}={v}" for k, v in labels),
+                "count": len(values),
+                "total": sum(values),
+            }
+            for q, value in zip(SUMMARY_QUANTILES, quantiles):
+                row[f"p{int(q * 100)}"] = value
+            rows.append(row)
+
+        return pd.DataFrame(
+            rows,
+            columns=["metric", "labels", "count", "total"]
+            + [f"p{int(q * 100)}" for q in SUMMARY_QUANTILES],
+        )
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def counter_values(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def write_prometheus(self, _path):
+        # Text exposition format, e.g. for node_exporter's textfile collector.
+        # Written to a temporary file first so a scrape never sees half of it
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+
+        def series(_name, _labels, _extra=()):
+            labels = ",".join(f'{k}="{v}"' for k, v in list(_labels) + list(_extra))
+            if labels:
+                return f"{METRICS_PREFIX}{_name}{{{labels}}}"
+            return f"{METRICS_PREFIX}{_name}"
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+            for (_name, labels), value in sorted(counters.items()):
+                if _name == name:
+                    lines.append(f"{series(name, labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} summary")
+            for (_name, labels), values in sorted(histograms.items()):
+                if _name != name:
+                    continue
+                for q, value in zip(
+                    SUMMARY_QUANTILES, np.quantile(values, SUMMARY_QUANTILES)
+                ):
+                    quantile = (("quantile", str(q)),)
+                    lines.append(f"{series(name, labels, quantile)} {value:.6f}")
+                lines.append(f"{series(name + '_sum', labels)} {sum(values):.6f}")
+                lines.append(f"{series(name + '_count', labels)} {len(values)}")
+
+        with open(_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(_path + ".tmp", _path)
+
+    def close(self):
+        self.log_to(None)
+
+
+# Process-wide registry every module reports to
+METRICS = Metrics()
+
+
+def timer_func(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with METRICS.timed("function_seconds", function=func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def timed_phase(_hooks, _activity_id, _phase):
+    # Reported to METRICS and to every hook as hook(activity_id, phase, seconds).
+    # METRICS passed as a hook is skipped, it already has the phase
+    start = timer()
+    try:
+        yield
+    finally:
+        seconds = timer() - start
+        METRICS(_activity_id, _phase, seconds)
+        for hook in _hooks or []:
+            if hook is not METRICS:
+                hook(_activity_id, _phase, seconds)
+
+
+@contextmanager
+def profiled(_profiler=None, output=None):
+    # Optional profile around a crawl: "cprofile" dumps pstats to `output`,
+    # "pyinstrument" (optional dependency) writes an HTML report. Both follow
+    # the calling thread, worker time shows up in the phase histograms
+    if _profiler is None:
+        yield
+        return
+
+    if _profiler == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output or "crawl.prof")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+    elif _profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError("pyinstrument is required for --profile pyinstrument")
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(output or "crawl.html", "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+
+    else:
+        raise ValueError(f"Unknown profiler {_profiler}")
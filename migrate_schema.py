@@ -0,0 +1,110 @@
+from sqlalchemy import inspect, select, text
+
+from data_model import Activity, ActivityEvent, Base, EventKmSummary
+from db_writer import insert_ignore
+from event_summaries import rebuild_summaries
+
+# In-place PostgreSQL migration from the original schema (text IDs, unit and
+# derived text columns on every split) to the current data_model. Runs in
+# one transaction, so a failure leaves the old schema untouched
+MIGRATION = [
+    # Foreign keys are dropped while the key columns change type
+    "ALTER TABLE splits DROP CONSTRAINT IF EXISTS splits_activity_id_fkey",
+    "ALTER TABLE activities DROP CONSTRAINT IF EXISTS activities_athlete_id_fkey",
+    # Strava IDs as BIGINT
+    "ALTER TABLE athletes ALTER COLUMN id TYPE BIGINT USING id::bigint",
+    "ALTER TABLE activities ALTER COLUMN id TYPE BIGINT USING id::bigint",
+    "ALTER TABLE activities "
+    "ALTER COLUMN athlete_id TYPE BIGINT USING athlete_id::bigint",
+    "ALTER TABLE splits ALTER COLUMN activity_id TYPE BIGINT USING activity_id::bigint",
+    "ALTER TABLE activities ADD CONSTRAINT activities_athlete_id_fkey "
+    "FOREIGN KEY (athlete_id) REFERENCES athletes (id)",
+    "ALTER TABLE splits ADD CONSTRAINT splits_activity_id_fkey "
+    "FOREIGN KEY (activity_id) REFERENCES activities (id)",
+    # Units as enums instead of repeated text
+    "DO $$ BEGIN CREATE TYPE pace_units AS ENUM ('km', 'mi'); "
+    "EXCEPTION WHEN duplicate_object THEN NULL; END $$",
+    "DO $$ BEGIN CREATE TYPE elevation_units AS ENUM ('m', 'ft'); "
+    "EXCEPTION WHEN duplicate_object THEN NULL; END $$",
+    "ALTER TABLE activities "
+    "ALTER COLUMN pace_units TYPE pace_units USING pace_units::pace_units",
+    "ALTER TABLE splits "
+    "ALTER COLUMN pace_units TYPE pace_units USING pace_units::pace_units",
+    "ALTER TABLE splits ALTER COLUMN elevation_units TYPE elevation_units "
+    "USING elevation_units::elevation_units",
+    # Compact numeric types
+    "ALTER TABLE activities ALTER COLUMN date TYPE DATE",
+    "ALTER TABLE splits ALTER COLUMN pace_seconds TYPE SMALLINT",
+    "ALTER TABLE splits ALTER COLUMN elevation TYPE SMALLINT",
+    # Strings derivable from the numeric columns
+    "ALTER TABLE activities DROP COLUMN IF EXISTS elapsed_str",
+    "ALTER TABLE activities DROP COLUMN IF EXISTS pace_str",
+    "ALTER TABLE splits DROP COLUMN IF EXISTS pace_str",
+    # Indexes for per-event queries and joins
+    "CREATE INDEX IF NOT EXISTS ix_activities_athlete_id ON activities (athlete_id)",
+    "CREATE INDEX IF NOT EXISTS ix_activities_date ON activities (date)",
+    "CREATE INDEX IF NOT EXISTS ix_activities_search_for_date "
+    "ON activities (search_for, date)",
+    "CREATE INDEX IF NOT EXISTS ix_splits_activity_id ON splits (activity_id)",
+]
+
+
+def needs_migration(_engine):
+    # Only PostgreSQL ever had the original schema
+    if _engine.dialect.name != "postgresql":
+        return False
+
+    columns = inspect(_engine).get_columns("activities")
+
+    return any(column["name"] == "pace_str" for column in columns)
+
+
+def migrate(_engine):
+    if not inspect(_engine).has_table("activities"):
+        # Fresh database, nothing to migrate
+        Base.metadata.create_all(_engine)
+        return
+
+    had_events = inspect(_engine).has_table(ActivityEvent.__tablename__)
+    had_summaries = inspect(_engine).has_table(EventKmSummary.__tablename__)
+
+    if needs_migration(_engine):
+        with _engine.begin() as conn:
+            for statement in MIGRATION:
+                conn.execute(text(statement))
+
+        print("Schema migrated")
+
+    # Tables added since, such as the crawl jobs
+    Base.metadata.create_all(_engine)
+
+    if not had_events:
+        # Activities crawled before events were tagged count for their own one
+        with _engine.begin() as conn:
+            conn.execute(
+                insert_ignore(_engine, ActivityEvent).from_select(
+                    ["activity_id", "search_for", "valid"],
+                    select(Activity.id, Activity.search_for, Activity.valid),
+                )
+            )
+
+        print("Activity events backfilled")
+
+    if not had_summaries:
+        with _engine.connect() as conn:
+            events = conn.execute(select(ActivityEvent.search_for).distinct())
+            events = events.scalars().all()
+
+        for event_name in events:
+            rebuild_summaries(_engine, event_name)
+
+        print(f"Event summaries rebuilt for {len(events)} events")
+
+
+if __name__ == "__main__":
+    from storage import get_engine
+
+    migrate(get_engine())
+    with get_engine().begin() as conn:
+        conn.execute(text("ANALYZE activities"))
+        conn.execute(text("ANALYZE splits"))
@@ -0,0 +1,222 @@
+import argparse
+import os
+import re
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+from sqlalchemy import func, select
+
+from data_model import ActivityEvent, ElevationUnit, PaceUnit, Split
+from event_summaries import FEET_TO_METRES
+from parquet_store import PARQUET_DIR, read_activities
+
+ANALYTICS_CACHE_DIR = os.getenv("STRAVA_ANALYTICS_CACHE", "analytics_cache")
+
+# Pace cost of climbing / credit for descending, in seconds per metre per km
+UPHILL_SECONDS_PER_METER = 1.0
+DOWNHILL_SECONDS_PER_METER = 0.55
+
+WALL_THRESHOLD = 0.15
+WALL_WINDOW = 2
+WALL_MIN_KM = 20
+
+
+class SplitsMatrix(NamedTuple):
+    # Row i is activity_ids[i], column k is km k + 1. Missing kms are NaN
+    activity_ids: np.ndarray
+    pace: np.ndarray
+    elevation: np.ndarray
+
+
+def splits_matrix(_activity_ids, _index, _pace, _elevation):
+    # Only whole kilometres, the last partial split is left out. Columns of
+    # an empty query come back as objects, hence the casts
+    _activity_ids = np.asarray(_activity_ids, dtype=np.int64)
+    _index = np.asarray(_index, dtype=np.int64)
+    _pace = np.asarray(_pace, dtype=np.float32)
+    _elevation = np.asarray(_elevation, dtype=np.float32)
+
+    full = _index % 1000 == 0
+    activity_ids, rows = np.unique(_activity_ids[full], return_inverse=True)
+    cols = _index[full] // 1000 - 1
+
+    shape = (len(activity_ids), int(cols.max()) + 1 if len(cols) else 0)
+    pace = np.full(shape, np.nan, dtype=np.float32)
+    elevation = np.full(shape, np.nan, dtype=np.float32)
+    pace[rows, cols] = _pace[full]
+    elevation[rows, cols] = _elevation[full]
+
+    return SplitsMatrix(activity_ids, pace, elevation)
+
+
+def metres(_elevation, _feet):
+    # Elevations as metres, _feet marks those stored in feet
+    elevation = np.asarray(_elevation, dtype=np.float32)
+
+    return np.where(_feet, elevation * FEET_TO_METRES, elevation)
+
+
+def load_splits_matrix_db(_engine, _search_for):
+    with _engine.connect() as conn:
+        splits = pd.read_sql(
+            select(
+                Split.activity_id,
+                Split.index,
+                Split.pace_seconds,
+                Split.elevation,
+                Split.elevation_units,
+            )
+            .join(ActivityEvent, ActivityEvent.activity_id == Split.activity_id)
+            .where(ActivityEvent.search_for == _search_for, ActivityEvent.valid)
+            # Columns are kilometres, mile splits would not line up
+            .where(Split.pace_units == PaceUnit.km),
+            conn,
+        )
+
+    units = [getattr(unit, "value", unit) for unit in splits["elevation_units"]]
+    feet = np.array(units, dtype=object) == ElevationUnit.ft.value
+
+    return splits_matrix(
+        splits["activity_id"].to_numpy(),
+        splits["index"].to_numpy(),
+        splits["pace_seconds"].to_numpy(),
+        metres(splits["elevation"].to_numpy(), feet),
+    )
+
+
+def load_splits_matrix_parquet(_search_for, root=PARQUET_DIR):
+    table = read_activities(root, _search_for, valid=True)
+    table = table.filter(pc.equal(table["pace_units"], PaceUnit.km.value))
+
+    parents = pc.list_parent_indices(table["split_index"]).to_numpy()
+    activity_ids = table["activity_id"].to_numpy()[parents]
+    feet = pc.equal(table["elevation_units"], ElevationUnit.ft.value)
+    feet = feet.fill_null(False).to_numpy()[parents]
+
+    return splits_matrix(
+        activity_ids,
+        pc.list_flatten(table["split_index"]).to_numpy(),
+        pc.list_flatten(table["split_pace_seconds"]).to_numpy(),
+        metres(pc.list_flatten(table["split_elevation"]).to_numpy(), feet),
+    )
+
+
+def cached_splits_matrix(_engine, _search_for, cache_dir=ANALYTICS_CACHE_DIR):
+    # The cache is reused while the event has the same number of activities
+    with _engine.connect() as conn:
+        num_activities = conn.execute(
+            select(func.count())
+            .select_from(ActivityEvent)
+            .where(ActivityEvent.search_for == _search_for, ActivityEvent.valid)
+        ).scalar()
+
+    slug = re.sub(r"\W+", "_", _search_for).strip("_").lower()
+    path = os.path.join(cache_dir, f"{slug}.npz")
+
+    if os.path.exists(path):
+        cached = np.load(path)
+        if int(cached["num_activities"]) == num_activities:
+            return SplitsMatrix(
+                cached["activity_ids"], cached["pace"], cached["elevation"]
+            )
+
+    matrix = load_splits_matrix_db(_engine, _search_for)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(
+        path,
+        num_activities=num_activities,
+        activity_ids=matrix.activity_ids,
+        pace=matrix.pace,
+        elevation=matrix.elevation,
+    )
+
+    return matrix
+
+
+def split_ratio(_matrix):
+    # Second half over first half time, below 1 is a negative split
+    half = _matrix.pace.shape[1] // 2
+    first = np.nansum(_matrix.pace[:, :half], axis=1)
+    second = np.nansum(_matrix.pace[:, half : 2 * half], axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return second / first
+
+
+def wall_km(_matrix, threshold=WALL_THRESHOLD, window=WALL_WINDOW, min_km=WALL_MIN_KM):
+    # First km from min_km on where pace stays `threshold` slower than the
+    # runner's first-half median for `window` kms in a row. 0 if never
+    if _matrix.pace.shape[1] < window:
+        return np.zeros(len(_matrix.activity_ids), dtype=int)
+
+    half = _matrix.pace.shape[1] // 2
+    baseline = np.nanmedian(_matrix.pace[:, :half], axis=1)
+
+    slow = _matrix.pace > baseline[:, None] * (1 + threshold)
+    sustained = slow[:, : slow.shape[1] - window + 1].copy()
+    for _offset in range(1, window):
+        sustained &= slow[:, _offset : slow.shape[1] - window + 1 + _offset]
+    sustained[:, : max(min_km - 1, 0)] = False
+
+    hit = sustained.any(axis=1)
+
+    return np.where(hit, sustained.argmax(axis=1) + 1, 0)
+
+
+def pace_variability(_matrix):
+    # Coefficient of variation of the km paces
+    return np.nanstd(_matrix.pace, axis=1) / np.nanmean(_matrix.pace, axis=1)
+
+
+def adjusted_pace(_matrix):
+    cost = np.where(
+        _matrix.elevation > 0,
+        _matrix.elevation * UPHILL_SECONDS_PER_METER,
+        _matrix.elevation * DOWNHILL_SECONDS_PER_METER,
+    )
+
+    return _matrix.pace - cost
+
+
+def adjusted_pace_percentiles(_matrix, percentiles=(10, 25, 50, 75, 90)):
+    summary = np.nanpercentile(adjusted_pace(_matrix), percentiles, axis=0)
+
+    return pd.DataFrame(
+        summary.T,
+        index=pd.RangeIndex(1, summary.shape[1] + 1, name="km"),
+        columns=[f"p{p}" for p in percentiles],
+    )
+
+
+def pacing_summary(_matrix):
+    return pd.DataFrame(
+        {
+            "activity_id": _matrix.activity_ids,
+            "split_ratio": split_ratio(_matrix),
+            "wall_km": wall_km(_matrix),
+            "pace_variability": pace_variability(_matrix),
+        }
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--event", default="Frankfurt Marathon")
+    parser.add_argument("--parquet")
+    args = parser.parse_args()
+
+    if args.parquet is not None:
+        matrix = load_splits_matrix_parquet(args.event, args.parquet)
+    else:
+        from storage import get_engine
+
+        matrix = cached_splits_matrix(get_engine(), args.event)
+
+    summary = pacing_summary(matrix)
+    print(summary.describe().to_string())
+    print(f"Negative splits: {(summary['split_ratio'] < 1).mean():.1%}")
+    print(f"Hit the wall: {(summary['wall_km'] > 0).mean():.1%}")
+    print(adjusted_pace_percentiles(matrix).to_string())
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import zstandard
+
+ARCHIVE_DIR = os.getenv("STRAVA_PAGE_ARCHIVE", "page_archive")
+ZSTD_LEVEL = 10
+
+
+class PageArchive:
+    # Content-addressed store of fetched HTML pages:
+    #   objects/ab/abcdef....html.zst  zstd-compressed page, named by its sha256
+    #   index.sqlite                   (url, fetched_at) -> sha256
+    def __init__(self, _path=ARCHIVE_DIR):
+        self.path = _path
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+
+        # Workers share one archive, so every access goes through the lock
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(
+            os.path.join(self.path, "index.sqlite"), check_same_thread=False
+        )
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT NOT NULL, "
+            "fetched_at REAL NOT NULL, "
+            "sha256 TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "PRIMARY KEY (url, fetched_at))"
+        )
+        self.index.commit()
+
+    def object_path(self, _sha256):
+        return os.path.join(self.path, "objects", _sha256[:2], f"{_sha256}.html.zst")
+
+    def store(self, _url, _html, fetched_at=None):
+        raw = _html.encode("utf-8")
+        sha256 = hashlib.sha256(raw).hexdigest()
+        path = self.object_path(sha256)
+
+        with self.lock:
+            # Identical pages are only written once
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw))
+                os.replace(tmp_path, path)
+
+            self.index.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                (_url, fetched_at or time.time(), sha256, len(raw)),
+            )
+            self.index.commit()
+
+        return sha256
+
+    def load(self, _sha256):
+        with open(self.object_path(_sha256), "rb") as f:
+            raw = zstandard.ZstdDecompressor().decompress(f.read())
+
+        return raw.decode("utf-8")
+
+    def latest(self, _url):
+        with self.lock:
+            row = self.index.execute(
+                "SELECT sha256 FROM pages WHERE url = ? "
+                "ORDER BY fetched_at DESC LIMIT 1",
+                (_url,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return self.load(row[0])
+
+    def close(self):
+        with self.lock:
+            self.index.close()
@@ -0,0 +1,269 @@
+import argparse
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import select
+
+from data_model import Activity, ActivityEvent, Split
+from split_normalizer import normalize_splits
+
+PARQUET_DIR = os.getenv("STRAVA_PARQUET_DIR", "parquet_store")
+EXPORT_CHUNK_SIZE = 5000
+SINK_FLUSH_EVERY = 1000
+
+# One row per activity, its splits stored as numeric arrays in list columns
+UNITS_TYPE = pa.dictionary(pa.int32(), pa.string())
+ACTIVITY_SCHEMA = pa.schema(
+    [
+        ("activity_id", pa.int64()),
+        ("athlete_id", pa.int64()),
+        ("name", pa.string()),
+        ("search_for", pa.string()),
+        ("date", pa.date32()),
+        ("valid", pa.bool_()),
+        ("distance", pa.float32()),
+        ("elapsed_seconds", pa.int32()),
+        ("pace_seconds", pa.int32()),
+        ("pace_units", UNITS_TYPE),
+        ("split_index", pa.list_(pa.int32())),
+        ("split_pace_seconds", pa.list_(pa.int32())),
+        ("split_elevation", pa.list_(pa.int16())),
+        ("elevation_units", UNITS_TYPE),
+    ]
+)
+
+PARTITION_COLUMNS = ["search_for", "date"]
+PARTITIONING = ds.partitioning(
+    pa.schema([("search_for", pa.string()), ("date", pa.date32())]), flavor="hive"
+)
+
+
+def unit_value(_unit):
+    # Units come as plain strings from a crawl and as enums from the DB
+    return getattr(_unit, "value", _unit)
+
+
+def split_list(_offsets, _values, _type):
+    # List column straight from the flat values of every activity
+    return pa.ListArray.from_arrays(
+        pa.array(_offsets, pa.int32()), pa.array(_values, _type.value_type)
+    )
+
+
+def activities_table(_activities, _splits):
+    # _activities: activities rows, _splits: their split columns (NumPy
+    # arrays), grouped by activity in the same order
+    columns = {name: [] for name in ACTIVITY_SCHEMA.names}
+
+    for activity in _activities:
+        columns["activity_id"].append(int(activity["id"]))
+        columns["athlete_id"].append(int(activity["athlete_id"]))
+        for name in ["name", "search_for", "date", "valid", "distance"]:
+            columns[name].append(activity[name])
+        for name in ["elapsed_seconds", "pace_seconds"]:
+            columns[name].append(activity[name])
+        columns["pace_units"].append(unit_value(activity["pace_units"]))
+
+    # Activities without splits get empty lists
+    counts = (
+        pd.Series(np.asarray(_splits["activity_id"]))
+        .value_counts()
+        .reindex(columns["activity_id"], fill_value=0)
+        .to_numpy()
+    )
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    # Units of an activity's first split stand for all of them
+    elevation_units = np.asarray(_splits["elevation_units"], dtype=object)
+    columns["elevation_units"] = [
+        unit_value(elevation_units[start]) if count > 0 else None
+        for start, count in zip(offsets[:-1], counts)
+    ]
+
+    arrays = []
+    for field in ACTIVITY_SCHEMA:
+        if field.type == UNITS_TYPE:
+            arrays.append(
+                pa.array(columns[field.name], pa.string()).dictionary_encode()
+            )
+        elif field.name.startswith("split_"):
+            split_column = field.name[len("split_") :]
+            arrays.append(split_list(offsets, _splits[split_column], field.type))
+        else:
+            arrays.append(pa.array(columns[field.name], field.type))
+
+    return pa.Table.from_arrays(arrays, schema=ACTIVITY_SCHEMA)
+
+
+def append(_table, root=PARQUET_DIR):
+    # Every append writes new files, existing ones are never rewritten
+    if _table.num_rows == 0:
+        return
+
+    pq.write_to_dataset(
+        _table,
+        root,
+        partition_cols=PARTITION_COLUMNS,
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+    )
+
+
+def read_activities(root=PARQUET_DIR, search_for=None, valid=None, columns=None):
+    if not os.path.exists(root):
+        return ACTIVITY_SCHEMA.empty_table()
+
+    dataset = ds.dataset(root, format="parquet", partitioning=PARTITIONING)
+
+    condition = None
+    if search_for is not None:
+        condition = ds.field("search_for") == search_for
+    if valid is not None:
+        valid_condition = ds.field("valid") == valid
+        condition = (
+            valid_condition if condition is None else condition & valid_condition
+        )
+
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+def pace_percentiles_per_km(_table, percentiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    # Flatten every split of every activity, then group by km in NumPy. A
+    # split ending at 2000m is km 2, a last partial one at 42195m is km 43
+    km = (pc.list_flatten(_table["split_index"]).to_numpy() + 999) // 1000
+    pace = pc.list_flatten(_table["split_pace_seconds"]).to_numpy()
+
+    order = np.lexsort((pace, km))
+    km, pace = km[order], pace[order]
+
+    kms, starts, counts = np.unique(km, return_index=True, return_counts=True)
+
+    summary = pd.DataFrame({"km": kms, "count": counts})
+    for p in percentiles:
+        # Lower nearest-rank percentile inside each sorted km group
+        summary[f"p{int(p * 100)}"] = pace[starts + ((counts - 1) * p).astype(int)]
+
+    return summary
+
+
+class ParquetSink:
+    # Consumer for stream_event_performances, appends every `flush_every`
+    def __init__(self, root=PARQUET_DIR, flush_every=SINK_FLUSH_EVERY):
+        self.root = root
+        self.flush_every = flush_every
+        self.activities = []
+        self.splits = []
+        self.events = []
+
+    def consume(self, _result):
+        self.activities.append(_result.activity)
+        self.splits.append(_result.splits)
+        self.events.extend(
+            (len(self.activities) - 1, event) for event in _result.events
+        )
+
+        if len(self.activities) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self.activities) == 0:
+            return
+
+        table = activities_table(self.activities, normalize_splits(self.splits))
+
+        # One row per event the activity counts for, as in activity_events
+        table = table.take([index for index, _event in self.events])
+        for name in ["search_for", "valid"]:
+            table = table.set_column(
+                ACTIVITY_SCHEMA.get_field_index(name),
+                ACTIVITY_SCHEMA.field(name),
+                pa.array(
+                    [event[name] for _index, event in self.events],
+                    ACTIVITY_SCHEMA.field(name).type,
+                ),
+            )
+
+        append(table, self.root)
+        self.activities = []
+        self.splits = []
+        self.events = []
+
+    def close(self):
+        self.flush()
+
+
+def export_event(_engine, _search_for, root=PARQUET_DIR):
+    # Incremental: activities already in the store are skipped
+    exported = set(
+        read_activities(root, _search_for, columns=["activity_id"])["activity_id"]
+        .to_numpy()
+        .tolist()
+    )
+
+    # Every activity tagged to the event, with its validity for this event
+    activity_columns = [
+        column
+        for column in Activity.__table__.columns
+        if column.name not in ["search_for", "valid"]
+    ]
+
+    with _engine.connect() as conn:
+        activities = pd.read_sql(
+            select(*activity_columns, ActivityEvent.search_for, ActivityEvent.valid)
+            .join(ActivityEvent, ActivityEvent.activity_id == Activity.id)
+            .where(ActivityEvent.search_for == _search_for),
+            conn,
+        )
+        activities = activities[~activities["id"].isin(exported)]
+
+        for _start in range(0, len(activities.index), EXPORT_CHUNK_SIZE):
+            chunk = activities.iloc[_start : _start + EXPORT_CHUNK_SIZE]
+
+            splits = pd.read_sql(
+                select(
+                    Split.activity_id,
+                    Split.index,
+                    Split.pace_seconds,
+                    Split.elevation,
+                    Split.elevation_units,
+                )
+                .where(Split.activity_id.in_(chunk["id"].tolist()))
+                .order_by(Split.activity_id, Split.index),
+                conn,
+            )
+
+            # Same activity order as the splits
+            rows = chunk.sort_values("id").to_dict("records")
+            for row in rows:
+                row["date"] = pd.Timestamp(row["date"]).date()
+
+            append(
+                activities_table(
+                    rows, {column: splits[column].to_numpy() for column in splits}
+                ),
+                root,
+            )
+
+    return len(activities.index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["export", "paces"])
+    parser.add_argument("--event", default="Frankfurt Marathon")
+    parser.add_argument("--root", default=PARQUET_DIR)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        from storage import get_engine
+
+        print(f"Exported {export_event(get_engine(), args.event, args.root)}")
+
+    else:
+        table = read_activities(args.root, args.event, valid=True)
+        print(pace_percentiles_per_km(table).to_string(index=False))
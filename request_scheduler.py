@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import METRICS
+
+# Requests per second to Strava, shared by every fetcher and worker. The rate
+# starts at DEFAULT_RATE and adapts AIMD-style between MIN_RATE and MAX_RATE:
+# each second of successful traffic adds ADDITIVE_INCREASE, a throttled
+# (429/503), slow or login-redirected response multiplies it by
+# MULTIPLICATIVE_DECREASE, at most once per DECREASE_COOLDOWN
+DEFAULT_RATE = 2.0
+MIN_RATE = 0.2
+MAX_RATE = 20.0
+BURST = 4
+ADDITIVE_INCREASE = 0.1
+MULTIPLICATIVE_DECREASE = 0.5
+DECREASE_COOLDOWN = 2.0
+SLOW_RESPONSE_SECONDS = 5.0
+
+# Throttled responses also pause every request, for a jittered exponential
+# backoff or the server's Retry-After
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+
+# Lower goes first: leaderboard pages decide which activities get crawled
+LEADERBOARD_PRIORITY = 0
+ACTIVITY_PRIORITY = 1
+PRIORITY_NAMES = {LEADERBOARD_PRIORITY: "leaderboard", ACTIVITY_PRIORITY: "activity"}
+
+
+def backoff_delay(_throttles, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    # Equal jitter: half of the exponential delay is fixed, half random, so
+    # workers throttled together do not all come back at once
+    delay = min(maximum, base * 2 ** (_throttles - 1))
+
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RequestScheduler:
+    # Token bucket with a priority queue of waiting requests, safe to share
+    # between threads
+    def __init__(
+        self, rate=DEFAULT_RATE, min_rate=MIN_RATE, max_rate=MAX_RATE, burst=BURST
+    ):
+        self.condition = threading.Condition()
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self.throttles = 0
+
+        self.waiting = []
+        self.tickets = itertools.count()
+
+    def configure(self, rate=None, max_rate=None):
+        with self.condition:
+            if max_rate is not None:
+                self.max_rate = max_rate
+            if rate is not None:
+                self.rate = rate
+            self.rate = max(self.min_rate, min(self.rate, self.max_rate))
+            self.condition.notify_all()
+
+    def refill(self, _now):
+        self.tokens = min(
+            self.burst, self.tokens + (_now - self.refilled_at) * self.rate
+        )
+        self.refilled_at = _now
+
+    def acquire(self, priority=ACTIVITY_PRIORITY):
+        # Blocks until this request may go out
+        start = time.monotonic()
+
+        with self.condition:
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+
+                if self.waiting[0] != ticket:
+                    # Woken up when the requests ahead of it go out
+                    self.condition.wait()
+                elif now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                elif self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    break
+
+            self.tokens -= 1
+            heapq.heappop(self.waiting)
+            self.condition.notify_all()
+
+        METRICS.observe(
+            "scheduler_wait_seconds",
+            time.monotonic() - start,
+            priority=PRIORITY_NAMES.get(priority, priority),
+        )
+
+    def success(self, _seconds):
+        if _seconds > SLOW_RESPONSE_SECONDS:
+            self.congestion("slow response")
+            return
+
+        with self.condition:
+            self.throttles = 0
+            self.rate = min(self.max_rate, self.rate + ADDITIVE_INCREASE / self.rate)
+
+    def congestion(self, _reason):
+        with self.condition:
+            now = time.monotonic()
+            if now - self.decreased_at < DECREASE_COOLDOWN:
+                return
+
+            previous = self.rate
+            self.rate = max(self.min_rate, self.rate * MULTIPLICATIVE_DECREASE)
+            self.decreased_at = now
+
+        METRICS.increment("scheduler_decreases_total", reason=_reason)
+        print(f"Request rate {previous:.2f}/s -> {self.rate:.2f}/s ({_reason})")
+
+    def throttled(self, retry_after=None):
+        # Every request waits out the backoff, not only the throttled one
+        self.congestion("throttled")
+
+        with self.condition:
+            self.throttles += 1
+            delay = retry_after
+            if delay is None:
+                delay = backoff_delay(self.throttles)
+
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.condition.notify_all()
+
+        METRICS.increment("scheduler_throttled_total")
+        print(f"Throttled, pausing requests for {delay:.1f}s")
+
+    @contextmanager
+    def request(self, priority=ACTIVITY_PRIORITY):
+        # For requests without a status code to look at, e.g. browser loads
+        self.acquire(priority)
+        start = time.monotonic()
+        yield
+        self.success(time.monotonic() - start)
+
+
+# Process-wide scheduler every fetcher goes through
+SCHEDULER = RequestScheduler()
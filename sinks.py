@@ -0,0 +1,86 @@
+from timeit import default_timer as timer
+
+from crawl_jobs import DEFAULT_MAX_ATTEMPTS, finish_job, mark_done
+from data_model import Athlete
+from db_writer import DEFAULT_BATCH_SIZE, BatchWriter
+from dedup import KnownIds
+from event_summaries import update_summaries
+
+# A sink consumes the ActivityResult items of stream_event_performances:
+#   sink.consume(result) for every scraped activity
+#   sink.close() once the stream ends or fails
+
+
+class DBSink:
+    def __init__(
+        self, _engine, batch_size=DEFAULT_BATCH_SIZE, max_attempts=DEFAULT_MAX_ATTEMPTS
+    ):
+        self.engine = _engine
+        self.max_attempts = max_attempts
+        self.known_athletes = KnownIds(_engine, Athlete)
+
+        self.jobs = {}
+        self.seen_jobs = set()
+        self.writer = BatchWriter(
+            _engine,
+            batch_size=batch_size,
+            on_flush=[self.checkpoint, update_summaries],
+            known_athletes=self.known_athletes,
+        )
+
+    def checkpoint(self, _conn, _activity_rows, _split_columns, _event_rows):
+        by_job = {}
+        for row in _activity_rows:
+            for job_id in self.jobs.pop(row["id"], ()):
+                by_job.setdefault(job_id, []).append(row["id"])
+
+        for job_id, activity_ids in by_job.items():
+            mark_done(_conn, job_id, activity_ids)
+
+    def consume(self, _result):
+        # Athletes seen before in this process are left out here, the
+        # writer looks up the rest in the DB once per batch
+        athlete = None
+        if int(_result.athlete["id"]) not in self.known_athletes:
+            athlete = _result.athlete
+
+        # Jobs of every buffered activity, checkpointed when its batch commits
+        self.jobs[_result.activity["id"]] = _result.job_ids
+        self.seen_jobs.update(_result.job_ids)
+
+        self.writer.add(athlete, _result.activity, _result.splits, _result.events)
+
+    def close(self):
+        self.writer.close()
+
+        for job_id in self.seen_jobs:
+            finish_job(self.engine, job_id, self.max_attempts)
+
+
+class ProgressSink:
+    def __init__(self, every=100):
+        self.every = every
+        self.count = 0
+        self.start = timer()
+
+    def consume(self, _result):
+        self.count += 1
+
+        if self.count % self.every == 0:
+            rate = self.count / (timer() - self.start)
+            print(f"{self.count} activities scraped ({rate:.2f}/s)")
+
+    def close(self):
+        print(f"{self.count} activities scraped in {(timer() - self.start):.1f}s")
+
+
+class ListSink:
+    # Keeps every result in memory, for small runs and notebooks
+    def __init__(self):
+        self.results = []
+
+    def consume(self, _result):
+        self.results.append(_result)
+
+    def close(self):
+        pass
@@ -0,0 +1,191 @@
+import sys
+import uuid
+from timeit import default_timer as timer
+from typing import NamedTuple
+
+import numpy as np
+
+from data_model import ElevationUnit, PaceUnit
+from text_parsers import (
+    ELEVATION_RE,
+    MINUS_SIGNS,
+    PACE_RE,
+    decimal_column,
+    elevation_column,
+    pace_column_to_seconds,
+    split_column_name,
+)
+
+# Columns of a normalized batch, as in the splits table
+SPLIT_COLUMNS = [
+    "id",
+    "activity_id",
+    "index",
+    "pace_seconds",
+    "pace_units",
+    "elevation",
+    "elevation_units",
+]
+
+
+class SplitCells(NamedTuple):
+    # Splits table of one activity as scraped, header and cell text in the
+    # account language. Normalized with the rest of its batch
+    activity_id: int
+    columns: tuple
+    rows: list
+
+
+class InvalidSplits(ValueError):
+    pass
+
+
+def check_split_cells(_cells):
+    # Run where the activity is scraped, so a cell the batch could not
+    # store fails this activity's crawl item instead of the whole batch
+    if len(_cells.rows) == 0:
+        return
+
+    names = [split_column_name(column) for column in _cells.columns]
+    missing = {"index", "pace", "elevation"} - set(names)
+    if missing:
+        raise InvalidSplits(
+            f"Activity {_cells.activity_id}: no {', '.join(sorted(missing))} "
+            f"column in {_cells.columns}"
+        )
+
+    pace_units = {unit.value for unit in PaceUnit}
+    elevation_units = {unit.value for unit in ElevationUnit}
+    columns = [names.index("index"), names.index("pace"), names.index("elevation")]
+
+    for number, row in enumerate(_cells.rows, 1):
+        index, pace, elevation = (row[column] for column in columns)
+        for sign, minus in MINUS_SIGNS.items():
+            elevation = elevation.replace(sign, minus)
+
+        try:
+            float(index.replace(",", "."))
+        except ValueError:
+            raise InvalidSplits(
+                f"Activity {_cells.activity_id} split {number}: index {index!r}"
+            )
+
+        z = PACE_RE.match(pace)
+        if z is None or z.group("units") not in pace_units:
+            raise InvalidSplits(
+                f"Activity {_cells.activity_id} split {number}: pace {pace!r}"
+            )
+
+        z = ELEVATION_RE.match(elevation)
+        if z is None or z.group("units") not in elevation_units:
+            raise InvalidSplits(
+                f"Activity {_cells.activity_id} split {number}: "
+                f"elevation {elevation!r}"
+            )
+
+
+def split_ids(_activity_ids, _numbers):
+    # Activity ID in the high and split number in the low 64 bits, so a
+    # re-scraped activity gets the same split IDs. Big-endian, so each
+    # 16-byte value is the UUID's bytes. V16 rather than S16, which would
+    # drop trailing zero bytes
+    ids = np.empty((len(_activity_ids), 2), dtype=">u8")
+    ids[:, 0] = _activity_ids
+    ids[:, 1] = _numbers
+
+    return ids.view("V16").ravel()
+
+
+def split_uuids(_ids):
+    # UUID objects, only for drivers that bind them
+    return [uuid.UUID(bytes=value) for value in _ids.tolist()]
+
+
+def split_id_strings(_ids):
+    # 32 hex digits, which PostgreSQL and DuckDB both read as UUIDs
+    return [value.hex() for value in _ids.tolist()]
+
+
+def normalize_splits(_cells):
+    # One pass over the SplitCells of a whole batch: each column is parsed
+    # once for all activities, into NumPy arrays grouped by activity in the
+    # order of _cells
+    counts = np.array([len(cells.rows) for cells in _cells], dtype=np.int64)
+
+    index_cells = []
+    pace_cells = []
+    elevation_cells = []
+    for cells in _cells:
+        if len(cells.rows) == 0:
+            continue
+
+        # Headers come in the account language, the same names in all
+        names = [split_column_name(column) for column in cells.columns]
+        values = list(zip(*cells.rows))
+        index_cells.extend(values[names.index("index")])
+        pace_cells.extend(values[names.index("pace")])
+        elevation_cells.extend(values[names.index("elevation")])
+
+    activity_ids = np.repeat(
+        np.array([int(cells.activity_id) for cells in _cells], dtype=np.int64), counts
+    )
+    ends = np.cumsum(counts)
+    numbers = np.arange(len(activity_ids)) - np.repeat(ends - counts, counts) + 1
+
+    # index holds whole kilometres, except a last partial split (e.g. "0,38")
+    km = decimal_column(index_cells)
+    last = ends[counts > 1] - 1
+    last = last[km[last] % 1 != 0]
+    km[last] += km[last - 1]
+
+    pace_seconds, pace_units = pace_column_to_seconds(pace_cells)
+    elevation, elevation_units = elevation_column(elevation_cells)
+
+    return {
+        "id": split_ids(activity_ids, numbers),
+        "activity_id": activity_ids,
+        "index": np.round(km * 1000).astype(np.int32),
+        "pace_seconds": pace_seconds.astype(np.int16),
+        "pace_units": pace_units,
+        "elevation": elevation.astype(np.int16),
+        "elevation_units": elevation_units,
+    }
+
+
+def split_rows(_columns):
+    # Plain Python values per row, for drivers without a bulk path
+    values = [
+        split_uuids(_columns[column]) if column == "id" else _columns[column].tolist()
+        for column in SPLIT_COLUMNS
+    ]
+
+    return [dict(zip(SPLIT_COLUMNS, row)) for row in zip(*values)]
+
+
+if __name__ == "__main__":
+    # Benchmark: python split_normalizer.py [NUM_ACTIVITIES]
+    num_activities = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rng = np.random.default_rng(0)
+
+    batch = []
+    for activity_id in range(num_activities):
+        paces = rng.integers(200, 400, 43)
+        rows = [
+            (str(km), f"{p // 60}:{p % 60:02d} /km", f"{e} m")
+            for km, p, e in zip(range(1, 43), paces, rng.integers(-9, 9, 42))
+        ]
+        rows.append(("0,2", f"{paces[-1] // 60}:{paces[-1] % 60:02d} /km", "0 m"))
+        batch.append(SplitCells(10**10 + activity_id, ("KM", "Ritmo", "Desn."), rows))
+
+    # The first Arrow call pays a one-off setup, not counted
+    normalize_splits(batch[:1])
+
+    t1 = timer()
+    columns = normalize_splits(batch)
+    t2 = timer()
+
+    num_splits = len(columns["id"])
+    print(
+        f"normalize_splits() {num_activities} activities, {num_splits} splits "
+        f"in {(t2 - t1) * 1000:.1f}ms"
+    )
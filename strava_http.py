@@ -0,0 +1,113 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import METRICS
+from request_scheduler import ACTIVITY_PRIORITY, LEADERBOARD_PRIORITY, SCHEDULER
+
+# Overridable to point the fetchers at a mock server
+STRAVA_URL = os.getenv("STRAVA_URL", "https://www.strava.com/")
+ACT_BASE_URL = f"{STRAVA_URL}activities/"
+SEGMENT_BASE_URL = f"{STRAVA_URL}segments/"
+
+HTTP_TIMEOUT = 30
+HTTP_POOL_SIZE = 10
+LEADERBOARD_PER_PAGE = 100
+
+# Answers that slow every fetcher down and are retried after the pause
+THROTTLE_STATUSES = [429, 503]
+THROTTLE_RETRIES = 5
+
+
+class SessionExpired(Exception):
+    pass
+
+
+def http_session(_cookies, _user_agent=None, pool_size=HTTP_POOL_SIZE):
+    session = requests.Session()
+
+    # Keep-alive connection pool, with retries on transient server errors.
+    # Throttling answers are left to the request scheduler
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=3, backoff_factor=0.5, status_forcelist=[500, 502, 504]
+        ),
+    )
+    session.mount("https://", adapter)
+
+    if _user_agent is not None:
+        session.headers["User-Agent"] = _user_agent
+
+    for cookie in _cookies:
+        session.cookies.set(
+            cookie["name"],
+            cookie["value"],
+            domain=cookie.get("domain"),
+            path=cookie.get("path", "/"),
+        )
+
+    return session
+
+
+def retry_after(_response):
+    # Only the delay-seconds form, an HTTP date falls back to the backoff
+    try:
+        return float(_response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def scheduled_request(_method, _url, priority=ACTIVITY_PRIORITY, **kwargs):
+    # Every request waits its turn in the scheduler and reports back how it went
+    for attempt in range(1, THROTTLE_RETRIES + 1):
+        SCHEDULER.acquire(priority)
+
+        with METRICS.timed("http_request_seconds"):
+            response = _method(_url, timeout=HTTP_TIMEOUT, **kwargs)
+        METRICS.increment("http_requests_total", status=response.status_code)
+
+        if response.status_code not in THROTTLE_STATUSES:
+            break
+        SCHEDULER.throttled(retry_after(response))
+
+    response.raise_for_status()
+
+    # Strava redirects to the login page once the session cookies expire, or
+    # when it wants a crawler to slow down
+    if "/login" in response.url:
+        SCHEDULER.congestion("login redirect")
+        raise SessionExpired(f"Redirected to login while fetching {_url}")
+
+    SCHEDULER.success(response.elapsed.total_seconds())
+
+    return response
+
+
+def fetch_page(_session, _url, params=None, headers=None, priority=ACTIVITY_PRIORITY):
+    return scheduled_request(
+        _session.get, _url, priority=priority, params=params, headers=headers
+    ).text
+
+
+def resolve_url(_session, _url):
+    # Where a URL redirects to, without downloading the page itself
+    return scheduled_request(_session.head, _url, allow_redirects=True).url
+
+
+def fetch_activity_overview(_session, _activity_id):
+    return fetch_page(_session, f"{ACT_BASE_URL}{_activity_id}/overview")
+
+
+def fetch_leaderboard_page(_session, _segment_id, _page, per_page=LEADERBOARD_PER_PAGE):
+    # Same partial results fragment the "next page" link loads via XHR
+    return fetch_page(
+        _session,
+        f"{SEGMENT_BASE_URL}{_segment_id}/leaderboard",
+        params={"page": _page, "per_page": per_page, "partial": "true"},
+        headers={"X-Requested-With": "XMLHttpRequest"},
+        priority=LEADERBOARD_PRIORITY,
+    )
@@ -1,594 +1,735 @@
+import argparse
 import pandas as pd
-import time
 import re
 import os
-from datetime import date
 from dotenv import load_dotenv
-import uuid
-import json
+import queue
+import threading
+import math
 from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import StaleElementReferenceException
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
 
+from activity_parser import (
+    SplitsNotRendered,
+    activity_details,
+    activity_result,
+    parse_activity_page,
+    split_cells,
+)
+from crawl_jobs import (
+    DEFAULT_MAX_ATTEMPTS,
+    DEFAULT_RETRY_BACKOFF,
+    create_job,
+    finish_job,
+    job_leaderboard,
+    mark_done,
+    mark_failed,
+    open_job,
+    pending_items,
+    retry_delay,
+)
+from dedup import DEDUP_CHUNK_SIZE, KnownIds
+from driver_manager import LEADERBOARD_WAIT, SPLITS_WAIT, ManagedDriver, session_cookies
+from db_writer import DEFAULT_BATCH_SIZE, tag_events
+from leaderboard_parser import leaderboard_dataframe, page_len, parse_leaderboard_page
+from leaderboard_snapshot import (
+    known_efforts,
+    save_snapshot,
+    unseen_efforts_stop,
+)
+from metrics import METRICS, profiled, timed_phase, timer_func
+from migrate_schema import migrate
+from page_archive import ARCHIVE_DIR, PageArchive
+from parquet_store import ParquetSink
+from request_scheduler import LEADERBOARD_PRIORITY, SCHEDULER
+from sinks import DBSink, ProgressSink
+from split_normalizer import check_split_cells
+from storage import get_engine
+from strava_http import (
+    LEADERBOARD_PER_PAGE,
+    fetch_activity_overview,
+    fetch_leaderboard_page,
+    http_session,
+    resolve_url,
+)
 from data_model import (
-    # Base,
-    Athlete,
     Activity,
     # Split,
 )
 
 load_dotenv()
 
-mes_index = {
-    "enero": 1,
-    "febrero": 2,
-    "marzo": 3,
-    "abril": 4,
-    "mayo": 5,
-    "junio": 6,
-    "julio": 7,
-    "agosto": 8,
-    "septiembre": 9,
-    "octubre": 10,
-    "noviembre": 11,
-    "diciembre": 12,
-}
-
 ACT_BASE_URL = "https://www.strava.com/activities/"
 SEGMENT_BASE_URL = "https://www.strava.com/segments/"
 SEGMENT_EFFORT_BASE_URL = "https://www.strava.com/segment_efforts/"
 ATHLETE_BASE_URL = "https://www.strava.com/athletes/"
 
-login_url = "https://www.strava.com/login"
+LOADING_DONE_XPATH = '//div[@class="loading-panel" and @style="display: none;"]'
+EFFORT_URL_RE = re.compile(r"/activities/(\d+)(?:/segments/|#)(\d+)")
+
 strava_email = os.getenv("STRAVA_LOGIN_EMAIL")
 strava_password = os.getenv("STRAVA_LOGIN_PASSWORD")
 
-postgres_ip = os.getenv("POSTGRES_SERVER_IP")
-postgres_port = os.getenv("POSTGRES_SERVER_PORT")
-postgres_user = os.getenv("POSTGRES_SERVER_USER")
-postgres_pass = os.getenv("POSTGRES_SERVER_PASSWORD")
-
-alchemy_engine = create_engine(
-    f"postgresql+psycopg2://{postgres_user}:{postgres_pass}@{postgres_ip}:{postgres_port}/stravadb"
-)
-
-
-def timer_func(func):
-    def wrapper(*args, **kwargs):
-        t1 = timer()
-        result = func(*args, **kwargs)
-        t2 = timer()
-        print(f"{func.__name__}() executed in {(t2-t1):.6f}s")
-        return result
-
-    return wrapper
-
-
-def selenium_webdriver():
-    # WebDriver options
-    webdriver_options = webdriver.ChromeOptions()
-    webdriver_options.headless = True
-    # webdriver_options.page_load_strategy = 'normal'
-    webdriver_options.page_load_strategy = "eager"
-
-    driver = webdriver.Chrome(
-        service=Service(executable_path=ChromeDriverManager().install()),
-        options=webdriver_options,
-    )
-
-    # Return objects
-    return driver
-
 
 def strava_login():
-    # Load Selenium WebDriver
-    if "driver" in vars():
-        if driver.service.is_connectable() is True:
-            pass
-
-    else:
-        driver = selenium_webdriver()
-
-        # Open website
-        driver.get(url=login_url)
-        time.sleep(2)
-
-        # Reject cookies
-        try:
-            driver.find_element(
-                by=By.XPATH,
-                value='.//button[@class="btn-deny-cookie-banner"]',
-            ).click()
-
-        except NoSuchElementException:
-            pass
-
-        # Login
-        driver.find_element(by=By.ID, value="email").send_keys(strava_email)
-        driver.find_element(by=By.ID, value="password").send_keys(strava_password)
-        time.sleep(1)
-
-        driver.find_element(by=By.XPATH, value='.//*[@type="submit"]').submit()
-
-        # Return objects
-        return driver
-
-
-def elapsed_str_to_seconds(_elapsed_str):
-    split_str = _elapsed_str.split(":")
-
-    if len(split_str) == 2:
-        mmss_re = "(\d+):(\d+)"
-        z = re.match(mmss_re, _elapsed_str)
-        mm, ss = z.groups()
-        return int(mm) * 60 + int(ss)
-    elif len(split_str) == 3:
-        hhmmss_re = "(\d+):(\d+):(\d+)"
-        z = re.match(hhmmss_re, _elapsed_str)
-        hh, mm, ss = z.groups()
-        return int(hh) * 3600 + int(mm) * 60 + int(ss)
-    else:
-        print("Invalid format")
-        return 0
+    # Starts and logs in on its first page load, reusing the warm profile
+    # and saved cookies of earlier runs
+    return ManagedDriver(strava_email, strava_password)
 
 
-def pace_str_to_seconds(_pace_str):
-    minutes, seconds = _pace_str.split(":")
-    pace_seconds = int(minutes) * 60 + int(seconds)
+def leaderboard_page_url(_segment_id, _page, per_page=None):
+    # Pages fetched directly are keyed by their page size as well
+    if per_page is not None:
+        return f"{SEGMENT_BASE_URL}{_segment_id}/leaderboard?page={_page}&per_page={per_page}"
 
-    return pace_seconds
+    return f"{SEGMENT_BASE_URL}{_segment_id}?page={_page}"
 
 
 @timer_func
-def get_segment_leaderboard(_driver, _segment_id, num_results=100):
-    _driver.get(
-        url=(SEGMENT_BASE_URL + _segment_id),
-    )
+def get_segment_leaderboard(
+    _driver, _segment_id, num_results=100, archive=None, stop=None
+):
+    # `stop(page)` ends the crawl early after the page it returns True for
+    # Browser loads go through the request scheduler like HTTP fetches. A
+    # browser start or recycle happens before, so it is not timed as a load
+    _driver.ensure()
+    with METRICS.timed("page_load_seconds", page="leaderboard"):
+        with SCHEDULER.request(LEADERBOARD_PRIORITY):
+            _driver.get(
+                url=(SEGMENT_BASE_URL + _segment_id),
+            )
 
-    WebDriverWait(_driver, 60).until(
-        EC.presence_of_element_located((By.XPATH, '//div[@id="results"]'))
-    )
+    with METRICS.timed("browser_wait_seconds", page="leaderboard"):
+        LEADERBOARD_WAIT.until(
+            _driver, EC.presence_of_element_located((By.XPATH, '//div[@id="results"]'))
+        )
 
+    # One innerHTML round-trip per page, rows are parsed offline
     leaderboard = _driver.find_elements(By.XPATH, value='//div[@id="results"]')
-    list_dfs = pd.read_html(leaderboard[0].get_attribute("innerHTML"))
-    leaderboard_df = list_dfs[0]
-
-    efforts = _driver.find_elements(
-        By.XPATH,
-        value='//div[@id="results"]//table//tr//td[@data-tracking-element="leaderboard_effort"]//a',
-    )
+    results_html = leaderboard[0].get_attribute("innerHTML")
+    if archive is not None:
+        archive.store(leaderboard_page_url(_segment_id, 1), results_html)
 
-    details = _driver.find_elements(
-        By.XPATH,
-        value='//div[@id="results"]//table//tr//td[@data-tracking-element="leaderboard_athlete"]',
-    )
-
-    for _idx, _zip in enumerate(zip(efforts, details)):
-        _effort, _details = _zip
-        link_to_effort = _effort.get_attribute("href")
-        json_props = _details.get_attribute("data-tracking-properties")
-        json_obj = json.loads(json_props)
+    pages = [parse_leaderboard_page(results_html)]
+    leaderboard_len = page_len(pages[-1])
 
-        leaderboard_df.loc[_idx, "link"] = link_to_effort
-        leaderboard_df.loc[_idx, "athlete_id"] = json_obj["athlete_id"]
-        leaderboard_df.loc[_idx, "activity_id"] = json_obj["activity_id"]
-        leaderboard_df.loc[_idx, "segment_effort_id"] = json_obj["segment_effort_id"]
-        leaderboard_df.loc[_idx, "rank"] = json_obj["rank"]
-
-    while len(leaderboard_df.index) < num_results:
+    while leaderboard_len < num_results and not (stop and stop(pages[-1])):
         next_page_link = _driver.find_element(
             By.XPATH, value='//li[@class="next_page"]//a'
         )
-        next_page_link.click()
-
-        time.sleep(0.2)
 
-        WebDriverWait(_driver, 60).until(
-            EC.presence_of_element_located(
-                (By.XPATH, '//div[@class="loading-panel" and @style="display: none;"]')
+        # Ready once the loading panel is hidden again over different results,
+        # instead of a fixed pause for the panel to show up first
+        previous_html = results_html
+        with METRICS.timed("browser_wait_seconds", page="leaderboard"):
+            SCHEDULER.acquire(LEADERBOARD_PRIORITY)
+            start = timer()
+            next_page_link.click()
+            LEADERBOARD_WAIT.until(
+                _driver,
+                lambda d: d.find_elements(By.XPATH, LOADING_DONE_XPATH)
+                and d.find_element(By.XPATH, '//div[@id="results"]').get_attribute(
+                    "innerHTML"
+                )
+                != previous_html,
+                ignored_exceptions=[StaleElementReferenceException],
             )
-        )
+            SCHEDULER.success(timer() - start)
 
         leaderboard = _driver.find_elements(By.XPATH, value='//div[@id="results"]')
-        list_dfs = pd.read_html(leaderboard[0].get_attribute("innerHTML"))
-
-        next_df = list_dfs[0]
-
-        efforts = _driver.find_elements(
-            By.XPATH,
-            value='//div[@id="results"]//table//tr//td[@data-tracking-element="leaderboard_effort"]//a',
-        )
-
-        details = _driver.find_elements(
-            By.XPATH,
-            value='//div[@id="results"]//table//tr//td[@data-tracking-element="leaderboard_athlete"]',
-        )
+        results_html = leaderboard[0].get_attribute("innerHTML")
+        if archive is not None:
+            archive.store(
+                leaderboard_page_url(_segment_id, len(pages) + 1), results_html
+            )
 
-        for _idx, _zip in enumerate(zip(efforts, details)):
-            _effort, _details = _zip
-            link_to_effort = _effort.get_attribute("href")
-            json_props = _details.get_attribute("data-tracking-properties")
-            json_obj = json.loads(json_props)
-
-            next_df.loc[_idx, "link"] = link_to_effort
-            next_df.loc[_idx, "athlete_id"] = json_obj["athlete_id"]
-            next_df.loc[_idx, "activity_id"] = json_obj["activity_id"]
-            next_df.loc[_idx, "segment_effort_id"] = json_obj["segment_effort_id"]
-            next_df.loc[_idx, "rank"] = json_obj["rank"]
-
-        leaderboard_df = pd.concat([leaderboard_df, next_df], ignore_index=True)
-
-    leaderboard_df["athlete_id"] = leaderboard_df["athlete_id"].astype(int)
-    leaderboard_df["athlete_id"] = leaderboard_df["athlete_id"].astype(str)
-    leaderboard_df["activity_id"] = leaderboard_df["activity_id"].astype(int)
-    leaderboard_df["activity_id"] = leaderboard_df["activity_id"].astype(str)
-    leaderboard_df["segment_effort_id"] = leaderboard_df["segment_effort_id"].astype(
-        int
-    )
-    leaderboard_df["segment_effort_id"] = leaderboard_df["segment_effort_id"].astype(
-        str
-    )
-    leaderboard_df["rank"] = leaderboard_df["rank"].astype(int)
+        pages.append(parse_leaderboard_page(results_html))
+        leaderboard_len += page_len(pages[-1])
 
-    return _driver, leaderboard_df
+    return _driver, leaderboard_dataframe(pages)
 
 
 @timer_func
-def get_activity_details(_driver, _activity_id):
-    _driver.get(
-        url=(f"{ACT_BASE_URL}{_activity_id}/overview"),
-    )
-
-    activity_name = _driver.find_element(
-        By.XPATH, '//*[contains(@class, "activity-name")]'
-    )
-
-    WebDriverWait(_driver, 60).until(
-        EC.presence_of_element_located(
-            (By.XPATH, '//div[contains(@class, "mile-splits")]')
-        )
-    )
-
-    table = _driver.find_elements(
-        By.XPATH, value='//div[contains(@class, "mile-splits")]'
-    )
-
-    df_list = pd.read_html(table[0].get_attribute("innerHTML"))
-    splits = df_list[0]
+def get_segment_leaderboard_http(
+    _session,
+    _segment_id,
+    num_results=100,
+    per_page=LEADERBOARD_PER_PAGE,
+    parallelism=4,
+    archive=None,
+    stop=None,
+):
+    def fetch(_page):
+        results_html = fetch_leaderboard_page(_session, _segment_id, _page, per_page)
+        if archive is not None:
+            archive.store(
+                leaderboard_page_url(_segment_id, _page, per_page), results_html
+            )
 
-    # date XPATH: //div[@class="details-container"]//time
-    activity_date = _driver.find_element(
-        By.XPATH, '//div[@class="details-container"]//time'
-    )
+        return parse_leaderboard_page(results_html)
 
-    fecha_re = "(\S+), (\d{1,2}) de (\S+) de (\d{2,4})"
-    z = re.match(fecha_re, activity_date.text)
-    # 0 Dia semana
-    # 1 Dia mes
-    # 2 Mes en letra
-    # 3 Año
+    num_pages = math.ceil(num_results / per_page)
+    pages = []
 
-    split_date = z.groups()
-    activity_date_obj = date(
-        int(split_date[3]), mes_index[split_date[2].lower()], int(split_date[1])
-    )
+    # Pages are fetched in waves of `parallelism`, a short page is the last one
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        for _first in range(1, num_pages + 1, parallelism):
+            wave = range(_first, min(_first + parallelism, num_pages + 1))
+            wave_pages = list(executor.map(fetch, wave))
+            pages.extend(wave_pages)
 
-    # athlete XPATH: //section[@id="heading"]//header//a[contains(@href,"athletes")]
-    athlete = _driver.find_element(
-        By.XPATH, '//section[@id="heading"]//header//a[contains(@href,"athletes")]'
-    )
+            if min(page_len(_p) for _p in wave_pages) < per_page:
+                break
+            if stop is not None and any(stop(_p) for _p in wave_pages):
+                break
 
-    # href template: /athletes/ATHLETE_ID
-    ath_id_re = "https:\/\/www.strava.com\/athletes\/(\d+)"
-    z = re.match(ath_id_re, athlete.get_attribute("href"))
-    ath_id = z.groups()[0]
+    leaderboard_df = leaderboard_dataframe(pages)
 
-    # distance XPATH: //section[@id="heading"]//div[contains(@class,"activity-stats")]//li[1]
-    distance = _driver.find_element(
-        By.XPATH,
-        '//section[@id="heading"]//div[contains(@class,"activity-stats")]//li[1]',
-    )
-    dist_text = distance.text.split("\n")[0]
+    return leaderboard_df.iloc[:num_results]
 
-    dist_re = "(\d+\.\d+) .{2}"
-    z = re.match(dist_re, dist_text.replace(",", "."))
-    activity_distance = float(z.groups()[0])
 
-    # total time XPATH: //section[@id="heading"]//div[contains(@class,"activity-stats")]//li[2]
-    elapsed = _driver.find_element(
-        By.XPATH,
-        '//section[@id="heading"]//div[contains(@class,"activity-stats")]//li[2]',
-    )
-    elapsed_text = elapsed.text.split("\n")[0]
-    elapsed_seconds = elapsed_str_to_seconds(elapsed_text)
+def leaderboard_from_archive(
+    _archive, _segment_id, num_results=100, per_page=None, stop=None
+):
+    pages = []
+    leaderboard_len = 0
+    page = 1
 
-    # pace XPATH: //section[@id="heading"]//div[contains(@class,"activity-stats")]//li[3]
-    pace = _driver.find_element(
-        By.XPATH,
-        '//section[@id="heading"]//div[contains(@class,"activity-stats")]//li[3]',
-    )
-    pace_re = "(\d+:\d{2}) \/(.{2})"
-    z = re.match(pace_re, pace.text.split("\n")[0])
-    pace_str, pace_units = z.groups()
-
-    pace_seconds = pace_str_to_seconds(pace_str)
-
-    activity_details = {
-        "athlete_id": ath_id,
-        "athlete_name": athlete.text,
-        "activity_id": _activity_id,
-        "activity_name": activity_name.text,
-        "activity_date": activity_date_obj,
-        "activity_distance": activity_distance,
-        "elapsed_seconds": elapsed_seconds,
-        "elapsed_time": elapsed_text,
-        "pace_str": pace_str,
-        "pace_seconds": pace_seconds,
-        "pace_units": pace_units,
-    }
-
-    if splits.loc[len(splits.index) - 1, "KM"] > int(activity_distance):
-        splits.loc[len(splits.index) - 1, "KM"] = (
-            splits.loc[len(splits.index) - 1, "KM"] / 100
+    while leaderboard_len < num_results and not (pages and stop and stop(pages[-1])):
+        results_html = _archive.latest(
+            leaderboard_page_url(_segment_id, page, per_page)
         )
+        if results_html is None:
+            break
 
-        if len(splits.index) > 1:
-            splits.loc[len(splits.index) - 1, "KM"] = (
-                splits.loc[len(splits.index) - 2, "KM"]
-                + splits.loc[len(splits.index) - 1, "KM"]
-            )
+        pages.append(parse_leaderboard_page(results_html))
+        leaderboard_len += page_len(pages[-1])
+        page += 1
 
-    splits["KM"] = splits["KM"] * 1000
-    splits["KM"] = splits["KM"].astype(int)
+    if len(pages) == 0:
+        raise LookupError(f"Segment {_segment_id} leaderboard is not archived")
 
-    return _driver, activity_details, splits
+    return leaderboard_dataframe(pages)
 
 
-def get_activity_details_from_segment_effort(_driver, _segment_effort):
-    effort_url = (
-        _segment_effort
-        if "segment_efforts" in _segment_effort
-        else SEGMENT_EFFORT_BASE_URL + _segment_effort
-    )
-    _driver.get(
-        url=(effort_url),
-    )
-    # time.sleep(3)
+def activity_overview_url(_activity_id):
+    return f"{ACT_BASE_URL}{_activity_id}/overview"
 
-    current_url = _driver.current_url
-    # url template: https://www.strava.com/activities/ACTIVITY_ID/segments/SEGMENT_EFFORT_ID
-    # url template(2): https://www.strava.com/activities/ACTIVITY_ID#SEGMENT_EFFORT_ID
-    url_re = "https:\/\/www\.strava\.com\/activities\/(\d+)\/segments\/(\d+)"
-    z = re.match(url_re, current_url)
 
-    if z is None:
-        url_re = "https:\/\/www\.strava\.com\/activities\/(\d+)#(\d+)"
-        z = re.match(url_re, current_url)
+def resolve_segment_effort(_driver, _http_session, _segment_effort):
+    # A segment effort redirects to its activity, either of:
+    #   https://www.strava.com/activities/ACTIVITY_ID/segments/SEGMENT_EFFORT_ID
+    #   https://www.strava.com/activities/ACTIVITY_ID#SEGMENT_EFFORT_ID
+    if _http_session is not None:
+        current_url = resolve_url(_http_session, _segment_effort)
+    else:
+        _driver.ensure()
+        with SCHEDULER.request():
+            _driver.get(url=_segment_effort)
+        current_url = _driver.current_url
 
-    act_id, effort_id = z.groups()
+    z = EFFORT_URL_RE.search(current_url)
+    if z is None:
+        raise LookupError(f"{_segment_effort} did not redirect to an activity")
+
+    return int(z.group(1))
+
+
+def scrape_activity(
+    _activity,
+    driver=None,
+    http_session=None,
+    archive=None,
+    replay=False,
+    on_phase=None,
+):
+    # The one activity-detail stage. _activity is an activity ID or a segment
+    # effort URL. Pages come from the archive when replaying, over HTTP when
+    # there is a session, from the browser otherwise or when the HTTP page
+    # lacks the splits table. Every phase is reported to the on_phase hooks
+    if isinstance(_activity, str) and "segment_efforts" in _activity:
+        if replay:
+            raise LookupError(f"{_activity} cannot be resolved from the archive")
+        if driver is None and http_session is None:
+            driver = strava_login()
+
+        with timed_phase(on_phase, _activity, "navigation"):
+            activity_id = resolve_segment_effort(driver, http_session, _activity)
+    else:
+        activity_id = int(_activity)
 
-    # overview = _driver.find_element(By.XPATH, '//a[contains(@href, "overview")]')
-    # overview.click()
+    url = activity_overview_url(activity_id)
+    page = None
 
-    _driver.get(
-        url=(f"{ACT_BASE_URL}{act_id}/overview"),
-    )
+    if replay:
+        with timed_phase(on_phase, activity_id, "navigation"):
+            html = archive.latest(url)
+        if html is None:
+            raise LookupError(f"Activity {activity_id} is not archived")
 
-    activity_name = _driver.find_element(
-        By.XPATH, '//*[contains(@class, "activity-name")]'
-    )
+        with timed_phase(on_phase, activity_id, "parsing"):
+            page = parse_activity_page(html, activity_id)
 
-    WebDriverWait(_driver, 60).until(
-        EC.presence_of_element_located(
-            (By.XPATH, '//div[contains(@class, "mile-splits")]')
-        )
-    )
+    elif http_session is not None:
+        with timed_phase(on_phase, activity_id, "navigation"):
+            html = fetch_activity_overview(http_session, activity_id)
+        if archive is not None:
+            with timed_phase(on_phase, activity_id, "extraction"):
+                archive.store(url, html)
 
-    table = _driver.find_elements(
-        By.XPATH, value='//div[contains(@class, "mile-splits")]'
-    )
+        try:
+            with timed_phase(on_phase, activity_id, "parsing"):
+                page = parse_activity_page(html, activity_id)
+        except SplitsNotRendered:
+            # Falls back to the browser, logging in only the first time
+            pass
 
-    df_list = pd.read_html(table[0].get_attribute("innerHTML"))
-    splits = df_list[0]
+    if page is None:
+        if driver is None:
+            driver = strava_login()
+
+        # Starting or recycling the browser is neither navigation nor a
+        # response time for the scheduler to adapt to
+        driver.ensure()
+        with timed_phase(on_phase, activity_id, "navigation"), SCHEDULER.request():
+            driver.get(url=url)
+
+        with timed_phase(on_phase, activity_id, "wait"):
+            SPLITS_WAIT.until(
+                driver,
+                EC.presence_of_element_located(
+                    (By.XPATH, '//div[contains(@class, "mile-splits")]')
+                ),
+            )
 
-    # date XPATH: //div[@class="details-container"]//time
-    activity_date = _driver.find_element(
-        By.XPATH, '//div[@class="details-container"]//time'
-    )
+        # One page_source round-trip, everything else is parsed offline
+        with timed_phase(on_phase, activity_id, "extraction"):
+            html = driver.page_source
+            if archive is not None:
+                archive.store(url, html)
 
-    fecha_re = "(\S+), (\d{1,2}) de (\S+) de (\d{2,4})"
-    z = re.match(fecha_re, activity_date.text)
-    # 0 Dia semana
-    # 1 Dia mes
-    # 2 Mes en letra
-    # 3 Año
+        with timed_phase(on_phase, activity_id, "parsing"):
+            page = parse_activity_page(html, activity_id)
 
-    split_date = z.groups()
-    activity_date_obj = date(
-        int(split_date[3]), mes_index[split_date[2].lower()], int(split_date[1])
-    )
+    # Splits are normalized later, with the rest of their batch. They are
+    # checked here, so bad cells fail this activity and not its batch
+    cells = split_cells(page)
+    check_split_cells(cells)
 
-    # athlete XPATH: //section[@id="heading"]//header//a[contains(@href,"athletes")]
-    athlete = _driver.find_element(
-        By.XPATH, '//section[@id="heading"]//header//a[contains(@href,"athletes")]'
-    )
+    return driver, activity_details(page), cells
 
-    # href template: /athletes/ATHLETE_ID
-    ath_id_re = "https:\/\/www.strava.com\/athletes\/(\d+)"
-    z = re.match(ath_id_re, athlete.get_attribute("href"))
-    ath_id = z.groups()[0]
 
-    # distance XPATH: //section[@id="heading"]//div[contains(@class,"activity-stats")]//li[1]
-    distance = _driver.find_element(
-        By.XPATH,
-        '//section[@id="heading"]//div[contains(@class,"activity-stats")]//li[1]',
+def get_activity_details(_driver, _activity_id, archive=None, on_phase=None):
+    return scrape_activity(
+        _activity_id, driver=_driver, archive=archive, on_phase=on_phase
     )
-    dist_text = distance.text.split("\n")[0]
-
-    dist_re = "(\d+\.\d+) .{2}"
-    z = re.match(dist_re, dist_text.replace(",", "."))
-    activity_distance = float(z.groups()[0])
 
-    # total time XPATH: //section[@id="heading"]//div[contains(@class,"activity-stats")]//li[2]
-    elapsed = _driver.find_element(
-        By.XPATH,
-        '//section[@id="heading"]//div[contains(@class,"activity-stats")]//li[2]',
-    )
-    elapsed_text = elapsed.text.split("\n")[0]
-    elapsed_seconds = elapsed_str_to_seconds(elapsed_text)
 
-    # pace XPATH: //section[@id="heading"]//div[contains(@class,"activity-stats")]//li[3]
-    pace = _driver.find_element(
-        By.XPATH,
-        '//section[@id="heading"]//div[contains(@class,"activity-stats")]//li[3]',
+def get_activity_details_from_segment_effort(_driver, _segment_effort, on_phase=None):
+    effort_url = (
+        _segment_effort
+        if "segment_efforts" in _segment_effort
+        else SEGMENT_EFFORT_BASE_URL + _segment_effort
     )
-    pace_re = "(\d+:\d{2}) \/(.{2})"
-    z = re.match(pace_re, pace.text.split("\n")[0])
-    pace_str, pace_units = z.groups()
-
-    pace_seconds = pace_str_to_seconds(pace_str)
-
-    activity_details = {
-        "athlete_id": ath_id,
-        "athlete_name": athlete.text,
-        "activity_id": act_id,
-        "activity_name": activity_name.text,
-        "activity_date": activity_date_obj,
-        "activity_distance": activity_distance,
-        "elapsed_seconds": elapsed_seconds,
-        "elapsed_time": elapsed_text,
-        "pace_str": pace_str,
-        "pace_seconds": pace_seconds,
-        "pace_units": pace_units,
-    }
-
-    if splits.loc[len(splits.index) - 1, "KM"] > int(activity_distance):
-        splits.loc[len(splits.index) - 1, "KM"] = (
-            splits.loc[len(splits.index) - 1, "KM"] / 100
-        )
-
-        if len(splits.index) > 1:
-            splits.loc[len(splits.index) - 1, "KM"] = (
-                splits.loc[len(splits.index) - 2, "KM"]
-                + splits.loc[len(splits.index) - 1, "KM"]
-            )
 
-    splits["KM"] = splits["KM"] * 1000
-    splits["KM"] = splits["KM"].astype(int)
+    return scrape_activity(effort_url, driver=_driver, on_phase=on_phase)
 
-    return _driver, activity_details, splits
 
+def activity_worker(
+    _work_queue,
+    _results_queue,
+    _driver=None,
+    _http_session=None,
+    _archive=None,
+    _replay=False,
+    _on_phase=None,
+):
+    # Selenium workers own one logged-in driver for their whole life, HTTP
+    # workers only log in if a page needs the browser fallback and replay
+    # workers never touch the network
+    driver = _driver
+    if driver is None and _http_session is None and not _replay:
+        driver = strava_login()
 
-@timer_func
-def get_event_performances(_base_segment, _event_distance, _event_name):
-    with Session(alchemy_engine) as s:
-        query_all_athletes = s.query(Athlete.id)
-        all_athletes = query_all_athletes.all()
+    while True:
+        activity_id = _work_queue.get()
 
-        query_all_activities = s.query(Activity.id)
-        all_activities = query_all_activities.all()
+        # None is the shutdown sentinel
+        if activity_id is None:
+            break
 
-    athletes_list = [ath[0] for ath in all_athletes]
-    activities_list = [act[0] for act in all_activities]
-
-    driver = strava_login()
-
-    driver, leaderboard = get_segment_leaderboard(driver, _base_segment, 5000)
-    details_list = []
-    splits_list = []
-
-    for _idx in range(len(leaderboard)):
-        # driver, activity_details, splits_df = get_activity_details_from_segment_effort(
-        #    driver, leaderboard.loc[_idx, "link"]
-        # )
-
-        activity_id = leaderboard.loc[_idx, "activity_id"]
-        if activity_id not in activities_list:
-            driver, activity_details, splits_df = get_activity_details(
-                driver, activity_id
+        try:
+            driver, activity_details, cells = scrape_activity(
+                activity_id,
+                driver=driver,
+                http_session=_http_session,
+                archive=_archive,
+                replay=_replay,
+                on_phase=_on_phase,
+            )
+            _results_queue.put((activity_id, activity_details, cells, None))
+
+        except Exception as e:
+            _results_queue.put((activity_id, None, None, e))
+
+    if driver is not None:
+        driver.close()
+
+    if _http_session is not None:
+        _http_session.close()
+
+
+def load_manifest(_path):
+    # CSV with one event per row: segment,distance,event
+    manifest = pd.read_csv(_path, dtype={"segment": str})
+
+    return list(manifest[["segment", "distance", "event"]].itertuples(index=False))
+
+
+def stream_batch_performances(
+    _events,
+    num_workers=1,
+    rate_limit=None,
+    fetch_mode="selenium",
+    archive=None,
+    replay=False,
+    num_results=5000,
+    leaderboard_per_page=LEADERBOARD_PER_PAGE,
+    resume=True,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    retry_backoff=DEFAULT_RETRY_BACKOFF,
+    on_phase=None,
+    incremental=False,
+    cookies=None,
+):
+    # _events holds (segment_id, event_distance, event_name) of every event.
+    # Their leaderboards are merged into one work set, so an activity on
+    # several of them is scraped once and tagged to all of its events
+    # Every table is created on a fresh database, e.g. a new sqlite:// file,
+    # and an older schema is brought up to date
+    engine = get_engine()
+    migrate(engine)
+    known_activities = KnownIds(engine, Activity)
+
+    # Direct leaderboard pages are archived under their page size
+    per_page = leaderboard_per_page if fetch_mode == "http" else None
+
+    # Replay runs entirely from the page archive, without logging in. HTTP
+    # fetchers share the given or saved login cookies, one keep-alive session
+    # each, and only start a browser if a page needs it
+    driver = None
+    if not replay and fetch_mode == "http":
+        user_agent = None
+        if cookies is None:
+            cookies, user_agent = session_cookies(strava_email, strava_password)
+    elif not replay:
+        driver = strava_login()
+
+    # Cap on requests per second over all workers, the scheduler adapts the
+    # actual rate below it
+    if rate_limit is not None:
+        SCHEDULER.configure(max_rate=rate_limit)
+
+    # Every pending activity with the jobs and events it was found for, in
+    # leaderboard order
+    work = {}
+    job_ids = []
+    leaderboard_rows = 0
+
+    for segment_id, event_distance, event_name in _events:
+        job_id = open_job(engine, segment_id, event_name) if resume else None
+
+        # An incremental refresh stops at the first page holding only
+        # efforts of the last snapshot, instead of crawling num_results rows.
+        # A new effort ranked below that page waits for the next full crawl
+        stop = None
+        if incremental:
+            known = known_efforts(engine, segment_id)
+            if known:
+                stop = unseen_efforts_stop(known)
+
+        # A resumed job already holds its leaderboard snapshot
+        if job_id is not None:
+            print(f"Resuming job {job_id}")
+            leaderboard = job_leaderboard(engine, job_id)
+
+        elif replay:
+            leaderboard = leaderboard_from_archive(
+                archive, segment_id, num_results, per_page, stop=stop
             )
 
-            if activity_details["athlete_id"] not in athletes_list:
-                this_athlete = Athlete(
-                    id=activity_details["athlete_id"],
-                    name=activity_details["athlete_name"],
+        elif fetch_mode == "http":
+            # One page at a time when most refreshes end on the first pages
+            with http_session(cookies, user_agent) as session:
+                leaderboard = get_segment_leaderboard_http(
+                    session,
+                    segment_id,
+                    num_results,
+                    per_page,
+                    parallelism=1 if stop is not None else 4,
+                    archive=archive,
+                    stop=stop,
                 )
 
-            this_activity = Activity(
-                id=activity_details["activity_id"],
-                athlete_id=activity_details["athlete_id"],
-                name=activity_details["activity_name"],
-                search_for=_event_name,
-                valid=True
-                if (
-                    abs(activity_details["activity_distance"] - _event_distance)
-                    / _event_distance
-                    < 0.05
-                )
-                else False,
-                date=activity_details["activity_date"],
-                distance=activity_details["activity_distance"],
-                elapsed_str=activity_details["elapsed_time"],
-                elapsed_seconds=activity_details["elapsed_seconds"],
-                pace_str=activity_details["pace_str"],
-                pace_seconds=activity_details["pace_seconds"],
-                pace_units=activity_details["pace_units"],
+        else:
+            driver, leaderboard = get_segment_leaderboard(
+                driver, segment_id, num_results, archive=archive, stop=stop
             )
 
-            splits_df = splits_df[["KM", "Ritmo", "Desn."]]
-            splits_df.rename(
-                columns={"KM": "index", "Ritmo": "pace_str", "Desn.": "elevation"},
-                inplace=True,
+        if job_id is None:
+            save_snapshot(engine, segment_id, leaderboard)
+            METRICS.increment(
+                "leaderboard_rows_total", len(leaderboard.index), segment=segment_id
             )
 
-            splits_df["id"] = [uuid.uuid4() for _ in range(len(splits_df.index))]
-            splits_df["activity_id"] = activity_details["activity_id"]
-            splits_df[["pace_str", "pace_units"]] = splits_df["pace_str"].str.split(
-                " /", n=1, expand=True
-            )
-            splits_df["pace_seconds"] = splits_df["pace_str"].apply(
-                lambda x: pace_str_to_seconds(x)
+        # One existence query per chunk of leaderboard rows
+        new_activities = set()
+        for _start in range(0, len(leaderboard), DEDUP_CHUNK_SIZE):
+            chunk = leaderboard.iloc[_start : _start + DEDUP_CHUNK_SIZE]
+            new_activities.update(known_activities.filter_new(chunk["activity_id"]))
+
+        if job_id is None:
+            existing = []
+            for activity_id in leaderboard["activity_id"]:
+                if activity_id not in new_activities:
+                    print(f"Activity {activity_id} already exists in DB")
+                    existing.append(int(activity_id))
+
+            # Scraped before, maybe for another event, only tagged to this one
+            tag_events(engine, existing, event_distance, event_name)
+
+            job_id = create_job(
+                engine,
+                segment_id,
+                event_name,
+                event_distance,
+                leaderboard,
+                new_activities,
             )
-            splits_df[["elevation", "elevation_units"]] = splits_df[
-                "elevation"
-            ].str.split(" ", n=1, expand=True)
-
-            splits_df["elevation"] = splits_df["elevation"].astype(int)
-
-            with Session(alchemy_engine) as s:
-                if activity_details["athlete_id"] not in athletes_list:
-                    s.add(this_athlete)
-                    s.commit()
-                    athletes_list.append(activity_details["athlete_id"])
 
-                s.add(this_activity)
-                s.commit()
-                activities_list.append(activity_details["activity_id"])
-
-                splits_df.to_sql(
-                    "splits", con=alchemy_engine, if_exists="append", index=False
+        job_ids.append(job_id)
+        leaderboard_rows += len(leaderboard.index)
+
+        for activity_id in pending_items(engine, job_id, max_attempts):
+            jobs, events = work.setdefault(activity_id, ([], []))
+            jobs.append(job_id)
+            events.append((event_distance, event_name))
+
+    print(f"{len(work)} activities to scrape from {leaderboard_rows} leaderboard rows")
+
+    work_queue = queue.Queue()
+    results_queue = queue.Queue()
+
+    remaining = 0
+    for activity_id in work:
+        work_queue.put(activity_id)
+        remaining += 1
+
+    # The leaderboard driver is already warm, so it becomes the first worker
+    workers = []
+    for _worker_idx in range(num_workers):
+        worker = threading.Thread(
+            target=activity_worker,
+            args=(work_queue, results_queue),
+            kwargs={
+                "_driver": driver if _worker_idx == 0 else None,
+                "_http_session": (
+                    http_session(cookies, user_agent)
+                    if fetch_mode == "http" and not replay
+                    else None
+                ),
+                "_archive": archive,
+                "_replay": replay,
+                "_on_phase": on_phase,
+            },
+            daemon=True,
+        )
+        worker.start()
+        workers.append(worker)
+
+    try:
+        while remaining > 0:
+            activity_id, activity_details, cells, error = results_queue.get()
+            remaining -= 1
+            jobs, events = work[activity_id]
+
+            if error is not None:
+                attempts = max(
+                    mark_failed(engine, job_id, activity_id, error) for job_id in jobs
                 )
+                METRICS.increment("activity_failures_total", error=type(error).__name__)
+                print(f"Activity {activity_id} failed ({attempts}): {error!r}")
+
+                # Retry later with exponential backoff, up to max_attempts
+                if attempts < max_attempts:
+                    retry = threading.Timer(
+                        retry_delay(attempts, retry_backoff),
+                        work_queue.put,
+                        args=(activity_id,),
+                    )
+                    retry.daemon = True
+                    retry.start()
+                    remaining += 1
+                    METRICS.increment("activity_retries_total")
+
+                continue
+
+            if activity_details["activity_id"] in known_activities:
+                for event_distance, event_name in events:
+                    tag_events(
+                        engine,
+                        [activity_details["activity_id"]],
+                        event_distance,
+                        event_name,
+                    )
+                with engine.begin() as conn:
+                    for job_id in jobs:
+                        mark_done(conn, job_id, [activity_details["activity_id"]])
+                METRICS.increment("activities_duplicate_total")
+                continue
+
+            known_activities.add(activity_details["activity_id"])
+            METRICS.increment("activities_scraped_total")
+
+            # Nothing is kept once the consumer has the result
+            yield activity_result(activity_details, cells, events, job_ids=jobs)
+
+    finally:
+        for _ in range(num_workers):
+            work_queue.put(None)
+
+    for worker in workers:
+        worker.join()
+
+    # Only closes the jobs if every item is already checkpointed, a DB sink
+    # closes them after its last flush otherwise
+    for job_id in job_ids:
+        finish_job(engine, job_id, max_attempts)
+
+
+def stream_event_performances(_base_segment, _event_distance, _event_name, **kwargs):
+    return stream_batch_performances(
+        [(_base_segment, _event_distance, _event_name)], **kwargs
+    )
 
-            details_list.append(activity_details)
-            splits_list.append(splits_df)
-        else:
-            print(f"Activity {activity_id} already exists in DB")
-
-    driver.close()
 
-    return leaderboard, details_list, splits_list
+@timer_func
+def get_batch_performances(
+    _events,
+    sinks=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    **kwargs,
+):
+    if sinks is None:
+        sinks = [
+            DBSink(
+                get_engine(),
+                batch_size=batch_size,
+                max_attempts=kwargs.get("max_attempts", DEFAULT_MAX_ATTEMPTS),
+            ),
+            ProgressSink(),
+        ]
+
+    ingested = 0
+    try:
+        for result in stream_batch_performances(_events, **kwargs):
+            for sink in sinks:
+                sink.consume(result)
+            ingested += 1
+
+    finally:
+        for sink in sinks:
+            sink.close()
+
+        # p50/p95/p99 of every phase, page load, wait and flush of the run
+        print(METRICS.summary().to_string(index=False))
+
+    return ingested
+
+
+def get_event_performances(
+    _base_segment,
+    _event_distance,
+    _event_name,
+    sinks=None,
+    batch_size=DEFAULT_BATCH_SIZE,
+    **kwargs,
+):
+    return get_batch_performances(
+        [(_base_segment, _event_distance, _event_name)],
+        sinks=sinks,
+        batch_size=batch_size,
+        **kwargs,
+    )
 
 
 if __name__ == "__main__":
-    # Base.metadata.create_all(alchemy_engine)
-    l, d, s = get_event_performances("16355877", 42.2, "Frankfurt Marathon")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--segment", default="16355877")
+    parser.add_argument("--distance", type=float, default=42.2)
+    parser.add_argument("--event", default="Frankfurt Marathon")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate-limit", type=float)
+    parser.add_argument("--fetch-mode", choices=["selenium", "http"], default="http")
+    parser.add_argument("--archive", default=ARCHIVE_DIR)
+    parser.add_argument("--no-archive", action="store_true")
+    parser.add_argument("--replay", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--num-results", type=int, default=5000)
+    parser.add_argument("--no-resume", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument("--parquet")
+    parser.add_argument("--manifest")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"])
+    parser.add_argument("--profile-output")
+    parser.add_argument("--metrics-jsonl")
+    parser.add_argument("--metrics-prom")
+    args = parser.parse_args()
+
+    if args.metrics_jsonl is not None:
+        METRICS.log_to(args.metrics_jsonl)
+
+    page_archive = None if args.no_archive else PageArchive(args.archive)
+
+    sinks = [
+        DBSink(
+            get_engine(), batch_size=args.batch_size, max_attempts=args.max_attempts
+        ),
+        ProgressSink(),
+    ]
+    if args.parquet is not None:
+        sinks.append(ParquetSink(args.parquet))
+
+    # A manifest crawls all of its events at once
+    if args.manifest is not None:
+        events = load_manifest(args.manifest)
+    else:
+        events = [(args.segment, args.distance, args.event)]
+
+    with profiled(args.profile, args.profile_output):
+        get_batch_performances(
+            events,
+            sinks=sinks,
+            num_workers=args.workers,
+            rate_limit=args.rate_limit,
+            fetch_mode=args.fetch_mode,
+            archive=page_archive,
+            replay=args.replay,
+            num_results=args.num_results,
+            resume=not args.no_resume,
+            max_attempts=args.max_attempts,
+            incremental=args.incremental,
+        )
+
+    if args.metrics_prom is not None:
+        METRICS.write_prometheus(args.metrics_prom)
+    METRICS.close()
+
+    if page_archive is not None:
+        page_archive.close()
@@ -0,0 +1,366 @@
+import datetime
+import re
+import sys
+from functools import lru_cache
+from timeit import default_timer as timer
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Month names as activity pages show them in each language Strava is served in.
+# Russian pages use the genitive form ("29 октября 2023 г.")
+LOCALE_MONTHS = {
+    "en": [
+        "january",
+        "february",
+        "march",
+        "april",
+        "may",
+        "june",
+        "july",
+        "august",
+        "september",
+        "october",
+        "november",
+        "december",
+    ],
+    "es": [
+        "enero",
+        "febrero",
+        "marzo",
+        "abril",
+        "mayo",
+        "junio",
+        "julio",
+        "agosto",
+        "septiembre",
+        "octubre",
+        "noviembre",
+        "diciembre",
+    ],
+    "de": [
+        "januar",
+        "februar",
+        "märz",
+        "april",
+        "mai",
+        "juni",
+        "juli",
+        "august",
+        "september",
+        "oktober",
+        "november",
+        "dezember",
+    ],
+    "fr": [
+        "janvier",
+        "février",
+        "mars",
+        "avril",
+        "mai",
+        "juin",
+        "juillet",
+        "août",
+        "septembre",
+        "octobre",
+        "novembre",
+        "décembre",
+    ],
+    "it": [
+        "gennaio",
+        "febbraio",
+        "marzo",
+        "aprile",
+        "maggio",
+        "giugno",
+        "luglio",
+        "agosto",
+        "settembre",
+        "ottobre",
+        "novembre",
+        "dicembre",
+    ],
+    "pt": [
+        "janeiro",
+        "fevereiro",
+        "março",
+        "abril",
+        "maio",
+        "junho",
+        "julho",
+        "agosto",
+        "setembro",
+        "outubro",
+        "novembro",
+        "dezembro",
+    ],
+    "nl": [
+        "januari",
+        "februari",
+        "maart",
+        "april",
+        "mei",
+        "juni",
+        "juli",
+        "augustus",
+        "september",
+        "oktober",
+        "november",
+        "december",
+    ],
+    "ru": [
+        "января",
+        "февраля",
+        "марта",
+        "апреля",
+        "мая",
+        "июня",
+        "июля",
+        "августа",
+        "сентября",
+        "октября",
+        "ноября",
+        "декабря",
+    ],
+}
+
+# A name means the same month in every language that uses it
+MONTHS = {
+    name: _idx + 1
+    for names in LOCALE_MONTHS.values()
+    for _idx, name in enumerate(names)
+}
+
+# Splits table headers in each language, mapped to the column names the rest
+# of the pipeline uses. Headers are compared lowercased and without dots
+SPLIT_HEADERS = {
+    "index": ["km", "mi", "mile", "milla", "meile", "mille", "miglio", "milha", "км"],
+    "pace": ["pace", "ritmo", "tempo", "allure", "темп"],
+    "elevation": [
+        "elev",
+        "elevation",
+        "desn",
+        "desnivel",
+        "höhe",
+        "hm",
+        "dén",
+        "dénivelé",
+        "disl",
+        "dislivello",
+        "elevação",
+        "hoogte",
+        "высота",
+    ],
+}
+SPLIT_COLUMN_NAMES = {
+    header: column for column, headers in SPLIT_HEADERS.items() for header in headers
+}
+
+# "domingo, 29 de octubre de 2023", "Sonntag, 29. Oktober 2023"
+DAY_MONTH_YEAR_RE = re.compile(
+    r"(\d{1,2})\.?\s+(?:de\s+)?([^\W\d_]+)\.?\s+(?:de\s+)?(\d{4})"
+)
+# "Sunday, October 29, 2023"
+MONTH_DAY_YEAR_RE = re.compile(r"([^\W\d_]+)\.?\s+(\d{1,2}),?\s+(\d{4})")
+# "2023年10月29日"
+YEAR_MONTH_DAY_RE = re.compile(
+    r"(\d{4})\s*[年년./-]\s*(\d{1,2})\s*[月월./-]\s*(\d{1,2})"
+)
+
+# The same patterns serve the scalar parsers (re) and the column parsers
+# (pyarrow's RE2), so both accept exactly the same strings
+DURATION_PATTERN = r"^\s*(?:(?P<hours>\d+):)?(?P<minutes>\d+):(?P<seconds>\d{2})\s*$"
+PACE_PATTERN = r"^\s*(?P<minutes>\d+):(?P<seconds>\d{2})\s*(?:/\s*(?P<units>\S+))?"
+ELEVATION_PATTERN = r"^\s*(?P<value>-?[\d.,]+)\s*(?P<units>\S*)"
+
+DURATION_RE = re.compile(DURATION_PATTERN)
+PACE_RE = re.compile(PACE_PATTERN)
+ELEVATION_RE = re.compile(ELEVATION_PATTERN)
+
+MINUS_SIGNS = {"−": "-", "–": "-"}
+THOUSANDS_RE = re.compile(r"[.,]")
+
+
+def elapsed_str_to_seconds(_elapsed_str):
+    z = DURATION_RE.match(_elapsed_str)
+    if z is None:
+        print("Invalid format")
+        return 0
+
+    hh, mm, ss = z.groups()
+    return int(hh or 0) * 3600 + int(mm) * 60 + int(ss)
+
+
+def pace_str_to_seconds(_pace_str):
+    # "4:16" or "4:16 /km"
+    z = PACE_RE.match(_pace_str)
+    if z is None:
+        print("Invalid format")
+        return 0
+
+    return int(z.group(1)) * 60 + int(z.group(2))
+
+
+def decimal_str_to_float(_decimal_str):
+    # Decimal comma or point, as the account language shows it
+    return float(_decimal_str.replace(",", "."))
+
+
+def elevation_str_to_int(_elevation_str):
+    # "-2 m", "1.234 ft": whole units, any separator is a thousands separator
+    for sign, minus in MINUS_SIGNS.items():
+        _elevation_str = _elevation_str.replace(sign, minus)
+
+    z = ELEVATION_RE.match(_elevation_str)
+    if z is None:
+        print("Invalid format")
+        return 0
+
+    return int(THOUSANDS_RE.sub("", z.group(1)))
+
+
+@lru_cache(maxsize=4096)
+def date_str_to_date(_date_str):
+    z = DAY_MONTH_YEAR_RE.search(_date_str)
+    if z is not None:
+        day, month, year = z.groups()
+    else:
+        z = MONTH_DAY_YEAR_RE.search(_date_str)
+        if z is not None:
+            month, day, year = z.groups()
+        else:
+            z = YEAR_MONTH_DAY_RE.search(_date_str)
+            if z is None:
+                raise ValueError(f"Unknown date format: {_date_str}")
+            year, month, day = z.groups()
+
+    if not month.isdigit():
+        if month.lower() not in MONTHS:
+            raise ValueError(f"Unknown month: {month}")
+        month = MONTHS[month.lower()]
+
+    return datetime.date(int(year), int(month), int(day))
+
+
+def split_column_name(_header):
+    return SPLIT_COLUMN_NAMES.get(_header.lower().replace(".", "").strip(), _header)
+
+
+def string_array(_values):
+    # Accepts lists, NumPy arrays and pandas Series of strings
+    if isinstance(_values, (pa.Array, pa.ChunkedArray)):
+        return _values
+    if isinstance(_values, (list, tuple)):
+        # Much faster as they are than through an object array
+        return pa.array(_values, pa.string())
+    return pa.Array.from_pandas(_values, type=pa.string())
+
+
+def int_field(_groups, _idx):
+    # Groups come back as struct fields in pattern order. An optional group
+    # that did not take part in the match is empty
+    field = pc.struct_field(_groups, [_idx])
+    field = pc.if_else(pc.equal(field, ""), "0", field)
+
+    return pc.cast(field, pa.int32())
+
+
+def str_field(_groups, _idx):
+    field = pc.struct_field(_groups, [_idx])
+
+    return pc.if_else(pc.equal(field, ""), None, field).to_numpy(
+        zero_copy_only=False, writable=True
+    )
+
+
+def elapsed_column_to_seconds(_values):
+    groups = pc.extract_regex(string_array(_values), DURATION_PATTERN)
+    seconds = pc.add(
+        pc.add(
+            pc.multiply(int_field(groups, 0), 3600),
+            pc.multiply(int_field(groups, 1), 60),
+        ),
+        int_field(groups, 2),
+    )
+
+    return seconds.fill_null(0).to_numpy(zero_copy_only=False, writable=True)
+
+
+def pace_column_to_seconds(_values):
+    # Seconds and units ("km", "mi") of a column of "4:16 /km" strings
+    groups = pc.extract_regex(string_array(_values), PACE_PATTERN)
+    seconds = pc.add(pc.multiply(int_field(groups, 0), 60), int_field(groups, 1))
+
+    return seconds.fill_null(0).to_numpy(
+        zero_copy_only=False, writable=True
+    ), str_field(groups, 2)
+
+
+def elevation_column(_values):
+    # Whole elevation and units of a column of "-2 m" strings
+    strings = string_array(_values)
+    for sign, minus in MINUS_SIGNS.items():
+        strings = pc.replace_substring(strings, sign, minus)
+
+    groups = pc.extract_regex(strings, ELEVATION_PATTERN)
+    value = pc.replace_substring_regex(
+        pc.struct_field(groups, [0]), THOUSANDS_RE.pattern, ""
+    )
+
+    return (
+        pc.cast(value, pa.int32())
+        .fill_null(0)
+        .to_numpy(zero_copy_only=False, writable=True),
+        str_field(groups, 1),
+    )
+
+
+def decimal_column(_values):
+    strings = pc.replace_substring(string_array(_values), ",", ".")
+
+    return pc.cast(strings, pa.float64()).to_numpy(zero_copy_only=False, writable=True)
+
+
+if __name__ == "__main__":
+    # Benchmark: python text_parsers.py [NUM_VALUES]
+    num_values = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rng = np.random.default_rng(0)
+
+    seconds = rng.integers(180, 600, num_values)
+    paces = [f"{s // 60}:{s % 60:02d} /km" for s in seconds]
+
+    elapsed = rng.integers(60, 30000, num_values)
+    durations = [
+        (
+            f"{s // 3600}:{s // 60 % 60:02d}:{s % 60:02d}"
+            if s >= 3600
+            else f"{s // 60}:{s % 60:02d}"
+        )
+        for s in elapsed
+    ]
+
+    elevations = [f"{e} m" for e in rng.integers(-60, 60, num_values)]
+
+    for name, values, scalar, column in [
+        ("pace", paces, pace_str_to_seconds, pace_column_to_seconds),
+        ("duration", durations, elapsed_str_to_seconds, elapsed_column_to_seconds),
+        ("elevation", elevations, elevation_str_to_int, elevation_column),
+    ]:
+        # The first Arrow call pays a one-off setup, not counted
+        column(values[:100])
+
+        t1 = timer()
+        scalar_result = [scalar(value) for value in values]
+        t2 = timer()
+        column_result = column(values)
+        t3 = timer()
+
+        if isinstance(column_result, tuple):
+            column_result = column_result[0]
+        assert np.array_equal(scalar_result, column_result)
+
+        print(
+            f"{name}: {num_values} values, scalar {t2 - t1:.3f}s, "
+            f"column {t3 - t2:.3f}s"
+        )